@@ -3,9 +3,10 @@ import pandas as pd
 import seaborn as sns
 
 from sklearn.metrics import pairwise_distances
-from scipy.stats import spearmanr
 from tqdm import tqdm
 
+from metrics import spearman_rows
+
 
 def calculate_edistance(X, Y):
     """
@@ -38,23 +39,20 @@ def get_model_stats(formatted_test_results):
     results_PR = dict()
 
 
-    for cell_type in formatted_test_results['cell_type'].unique():
-        losses = list()
-
-        df_subset = formatted_test_results[formatted_test_results['cell_type'] == cell_type]
-
-        pred_losses = list()
-        null_losses = list()
-        PCP = list()
-        PR = list()
+    compounds = list(formatted_test_results['compound'].unique())
+    doses = sorted(formatted_test_results['dose'].unique())
 
+    for cell_type in formatted_test_results['cell_type'].unique():
+        # (n_compounds, n_doses) distances to control, NaN where a dose was not tested
+        distances_to_ctrl = np.full((len(compounds), len(doses)), np.nan)
 
-        for compound in tqdm(list(formatted_test_results['compound'].unique())):
-            distances_to_ctrl = list()
-            for dose in sorted(formatted_test_results['dose'].unique()):
+        for i, compound in enumerate(tqdm(compounds)):
+            for j, dose in enumerate(doses):
                 df_subset = formatted_test_results[(formatted_test_results['cell_type'] == cell_type) &
                                          (formatted_test_results['compound'] == compound) &
                                          (formatted_test_results['dose'] == dose)]
+                if len(df_subset) == 0:
+                    continue
 
                 ctrl_X = np.array(df_subset['ctrl_emb'].tolist())
                 pert_X = np.array(df_subset['pert_emb'].tolist())
@@ -64,26 +62,16 @@ def get_model_stats(formatted_test_results):
                 edist_ctrl_pred = calculate_edistance(ctrl_X, pred_X)
                 edist_pert_pred = calculate_edistance(pert_X, pred_X)
 
-                distances_to_ctrl.append(edist_ctrl_pred)
-
-                if edist_pert_pred < edist_ctrl_pred:
-                    PCP.append(True)
-                else:
-                    PCP.append(False)
-
-                pred_losses.append(edist_pert_pred)
-                null_losses.append(edist_ctrl_pert)
-
-                key1 = cell_type + "_" + (compound + "_" + str(dose)
-                results_pred_loss[key1] = pred_losses
-                results_null_loss[key1] = null_losses
-                results_PCP[key1] = PCP
+                distances_to_ctrl[i, j] = edist_ctrl_pred
 
-            corr, _ = spermanr(list(formatted_test_results['dose'].unique()), distances_to_ctrl)
-            PR.append(corr)
+                key1 = cell_type + "_" + compound + "_" + str(dose)
+                results_pred_loss[key1] = edist_pert_pred
+                results_null_loss[key1] = edist_ctrl_pert
+                results_PCP[key1] = edist_pert_pred < edist_ctrl_pred
 
-        key2 = cell_type + "_" + compound
-        results_PR[key2] = PR
+        # dose/distance rank correlation of every compound in one call
+        for compound, corr in zip(compounds, spearman_rows(distances_to_ctrl, doses)):
+            results_PR[cell_type + "_" + compound] = corr
 
     return results_pred_loss, results_null_loss, results_PCP, results_PR
 
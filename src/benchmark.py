@@ -0,0 +1,76 @@
+import time
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+from torch.utils.data import Subset
+
+from evaluator import FiLMModelEvaluator
+from utils import get_model_stats
+
+
+# training modes as config overrides of train_params
+MODES = {
+    "fp32 eager": dict(),
+    "bf16 autocast": {"autocast": 'bf16'},
+    "compile": {"compile": 'default'},
+    "bf16 autocast + compile": {"autocast": 'bf16', "compile": 'default'},
+    "fused adam": {"fused_optimizer": True},
+}
+
+
+def benchmark_modes(config_path, model, sciplex_dataset_train, sciplex_dataset_validation, sciplex_dataset_test,
+                    modes=None, seed=0, warmup_steps=10):
+    """
+    Train and test one model per training mode (see MODES) from the same seed and report training
+    throughput and test quality against fp32 eager. Validation is switched off so only training steps
+    are timed; the compile modes include their compilation time. Every mode starts from torch.manual_seed(seed),
+    which fixes the initial weights and the batch order, and from the datasets' rng reseeded with seed and
+    their controls redrawn, so modes with 'epoch' or 'batch' control sampling train on the same pairings.
+    First, an untimed fp32 eager epoch of warmup_steps batches (0 to skip) takes the one-time process
+    costs (thread pools, page cache), so they do not land on the first mode.
+
+    Returns a DataFrame with the steps per second, training time, final training loss and mean test
+    E-distance (predicted vs perturbed, see utils.get_model_stats) of every mode.
+    """
+    if modes is None:
+        modes = MODES
+
+    validation_off = {"every_n_steps": None, "every_n_epochs": None}
+    if warmup_steps:
+        with open(config_path, 'r') as file:
+            batch_size = yaml.safe_load(file)['train_params']['batch_size']
+        warmup_data = Subset(sciplex_dataset_train, range(min(len(sciplex_dataset_train), warmup_steps * batch_size)))
+        overrides = {"train_params": {"num_epochs": 1, "tensor_store": False}, "validation_params": validation_off}
+        FiLMModelEvaluator(config_path, model, warmup_data, sciplex_dataset_validation,
+                           sciplex_dataset_test, config_overrides=overrides).train()
+
+    results = list()
+    for name, train_params in modes.items():
+        print("Benchmarking mode:", name)
+        overrides = {"train_params": train_params, "validation_params": validation_off}
+
+        torch.manual_seed(seed)
+        for dataset in (sciplex_dataset_train, sciplex_dataset_validation, sciplex_dataset_test):
+            if hasattr(dataset, 'rng'):
+                dataset.rng = np.random.default_rng(seed)
+                dataset.resample_controls()
+        evaluator = FiLMModelEvaluator(config_path, model, sciplex_dataset_train, sciplex_dataset_validation,
+                                       sciplex_dataset_test, config_overrides=overrides)
+
+        start = time.perf_counter()
+        evaluator.train()
+        train_time = time.perf_counter() - start
+
+        evaluator.test()
+        pred_loss, _, _ = get_model_stats(evaluator.get_test_results())
+
+        results.append({"mode": name,
+                        "steps_per_s": len(evaluator.losses_train) / train_time,
+                        "train_time": train_time,
+                        "final_loss": float(evaluator.losses_train[-1]),
+                        "edistance": float(np.mean(list(pred_loss.values())))})
+
+    results = pd.DataFrame(results)
+    print(results)
+    return results
@@ -0,0 +1,167 @@
+import os
+import hashlib
+import torch
+import numpy as np
+import anndata as ad
+
+
+class AnnDataSource():
+    """
+    Single handle on a preprocessed h5ad file, shared by all dataset splits built from it.
+
+    Modes:
+        'memory': X is read fully once into a numpy array (default)
+        'mmap':   X is exported once to a .npy file next to the h5ad and memory-mapped
+        'backed': obs is loaded, X stays on disk (anndata backed='r') and rows are read on demand;
+                  slowest per batch (h5py fancy indexing), only for files that do not fit in memory
+
+    The source can be pickled into DataLoader workers: file handles are dropped and reopened
+    lazily in the worker. An in-memory X is moved to shared memory by share_memory(), called
+    only when a loader with workers is built.
+    """
+
+    def __init__(self, adata_file, mode='memory'):
+        if mode not in ('backed', 'mmap', 'memory'):
+            raise ValueError(f"Unsupported data source mode: {mode}")
+
+        self.adata_file = adata_file
+        self.mode = mode
+        self.file_version = file_version(adata_file)
+        self._adata = None
+        self._X = None
+        self._X_shared = None
+
+        if self.mode == 'memory':
+            X = self.adata.X[:]
+            if hasattr(X, 'toarray'):
+                X = X.toarray()
+            self._X = np.asarray(X, dtype=np.float32)
+        elif self.mode == 'mmap':
+            self.export_npy()
+
+    def share_memory(self):
+        """
+        Move an in-memory X into a shared-memory buffer, so DataLoader workers do not copy it
+        """
+        if self.mode == 'memory' and self._X_shared is None:
+            self._X_shared = torch.from_numpy(self._X).share_memory_()
+            self._X = self._X_shared.numpy()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_adata'] = None
+        if self.mode != 'memory' or self._X_shared is not None:
+            state['_X'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._X_shared is not None:
+            self._X = self._X_shared.numpy()
+
+    def reset(self):
+        """
+        Drop open file handles (e.g. after a fork), they are reopened on next access
+        """
+        self._adata = None
+        if self.mode != 'memory':
+            self._X = None
+
+    @property
+    def adata(self):
+        if self._adata is None:
+            self._adata = ad.read_h5ad(self.adata_file, backed='r')
+        return self._adata
+
+    @property
+    def obs(self):
+        return self.adata.obs
+
+    @property
+    def X(self):
+        if self._X is None:
+            if self.mode == 'mmap':
+                self._X = np.load(self.npy_path(), mmap_mode='r')
+            else:
+                self._X = self.adata.X
+        return self._X
+
+    def content_hash(self):
+        """
+        SHA-256 of the h5ad file contents, computed once per file version. Raises if the file
+        was replaced since the source was opened, as the hash would no longer describe the loaded obs.
+        """
+        if file_version(self.adata_file) != self.file_version:
+            raise RuntimeError(f"{self.adata_file} changed on disk since it was opened, reopen the data source")
+
+        key = (os.path.abspath(self.adata_file),) + self.file_version
+        if key not in _content_hashes:
+            digest = hashlib.sha256()
+            with open(self.adata_file, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 24), b''):
+                    digest.update(block)
+            _content_hashes[key] = digest.hexdigest()
+        return _content_hashes[key]
+
+    @property
+    def n_vars(self):
+        return self.X.shape[1]
+
+    def npy_path(self):
+        return os.path.splitext(self.adata_file)[0] + ".X.npy"
+
+    def export_npy(self, chunk_size=65536):
+        """
+        Write X to a float32 .npy file next to the h5ad (once, or again if the h5ad is newer)
+        and return its path
+        """
+        path = self.npy_path()
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(self.adata_file):
+            return path
+
+        X = self.adata.X
+        out = np.lib.format.open_memmap(path + ".tmp", mode='w+', dtype=np.float32, shape=X.shape)
+        for start in range(0, X.shape[0], chunk_size):
+            out[start:start + chunk_size] = X[start:start + chunk_size]
+        out.flush()
+        del out
+        os.replace(path + ".tmp", path)
+
+        return path
+
+    def take(self, rows):
+        """
+        Gather rows of X as a float32 array
+        """
+        rows = np.asarray(rows)
+        if isinstance(self.X, np.ndarray):
+            return np.asarray(self.X[rows], dtype=np.float32)
+
+        # h5py only supports increasing, unique indices
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        return np.asarray(self.X[unique_rows], dtype=np.float32)[inverse.reshape(rows.shape)]
+
+
+_sources = dict()
+_content_hashes = dict()
+
+
+def file_version(path):
+    """
+    (size, mtime) of a file, changes whenever the file is rewritten or replaced
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def open_data_source(adata_file, mode='memory'):
+    """
+    Return the shared data source for a file, opening it on first use or again when the file
+    changed on disk. To share a source explicitly, pass the AnnDataSource to the datasets instead.
+    """
+    key = (os.path.abspath(adata_file), mode)
+    source = _sources.get(key)
+    if source is None or source.file_version != file_version(adata_file):
+        # the stale source is released once no dataset refers to it anymore
+        _sources[key] = AnnDataSource(adata_file, mode=mode)
+    return _sources[key]
@@ -1,7 +1,11 @@
+import os
+import json
+import shutil
+import hashlib
 import torch
 import pandas as pd
 import pickle as pkl
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import random
 import numpy as np
 import math
@@ -11,8 +15,133 @@ from tqdm import tqdm
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import MinMaxScaler
 
+from data_source import AnnDataSource, open_data_source
+
+
+def match_controls(treated_rows, cell_types, is_vehicle, rng):
+    """
+    Draw one random vehicle cell of the same cell type for every treated row.
+    Treated rows are grouped by cell type and each group is matched with a single RNG call.
+    """
+    control_rows = np.empty(len(treated_rows), dtype=np.int64)
+    treated_cell_types = cell_types[treated_rows]
+
+    for cell_type in np.unique(treated_cell_types):
+        control_pool = np.flatnonzero(is_vehicle & (cell_types == cell_type))
+        if len(control_pool) == 0:
+            raise ValueError(f"No vehicle controls for cell type: {cell_type}")
+
+        in_group = np.flatnonzero(treated_cell_types == cell_type)
+        control_rows[in_group] = control_pool[rng.integers(len(control_pool), size=len(in_group))]
+
+    return control_rows
+
+
+def init_worker(worker_id):
+    """
+    DataLoader worker_init_fn: seeds numpy, random and the dataset RNG from the per-worker torch seed,
+    and drops file handles inherited from the parent so the worker reopens its own
+    """
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+    dataset = torch.utils.data.get_worker_info().dataset
+    if hasattr(dataset, 'rng'):
+        dataset.rng = np.random.default_rng(seed)
+    if hasattr(dataset, 'source'):
+        dataset.source.reset()
+
+
+def collate_batch(batch):
+    """
+    Batches returned by __getitems__ are already stacked, so collation is a no-op
+    """
+    return batch
+
+
+class BatchIndexSampler(Sampler):
+    """
+    Yields batches as numpy index arrays sliced from one permutation per epoch,
+    to be used together with the datasets' __getitems__ and collate_batch.
+    Permutations come from a torch.Generator: seeded once with seed, or (like DataLoader's RandomSampler)
+    reseeded every epoch from the global torch RNG, so torch.manual_seed makes runs repeatable.
+    """
+
+    def __init__(self, n_samples, batch_size, shuffle=True, drop_last=False, seed=None):
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator()
+            self.generator.manual_seed(seed)
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = self.generator
+            if generator is None:
+                generator = torch.Generator()
+                generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+            order = torch.randperm(self.n_samples, generator=generator).numpy()
+        else:
+            order = np.arange(self.n_samples)
+
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            yield order[start:start + self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_samples // self.batch_size
+        return math.ceil(self.n_samples / self.batch_size)
+
+
+class CompoundEmbeddings():
+    """
+    Registry of drug embeddings. Every unique compound is parsed once into a contiguous
+    (n_compounds + 1, drug_emb_dim) float32 matrix; the last row is all zeros and stands for
+    "no compound", so index -1 can be used for negative pairs.
+    """
+
+    def __init__(self, compounds, embeddings):
+        self.compounds = np.append(np.asarray(compounds, dtype=object), None)
+        self.embeddings = np.vstack([np.asarray(embeddings, dtype=np.float32),
+                                     np.zeros((1, embeddings.shape[1]), dtype=np.float32)])
+
+    @classmethod
+    def from_obs(cls, obs, rows, drug_emb_dim):
+        """
+        Build the registry from the compounds found in the given obs rows.
+        Returns the registry and the compound index of every row.
+        """
+        product_name = obs['product_name'].to_numpy()[rows]
+        sm_embedding = obs['sm_embedding'].to_numpy()[rows]
+
+        compounds, first_row, compound_idx = np.unique(product_name.astype(str), return_index=True,
+                                                       return_inverse=True)
+        embeddings = np.array([ast.literal_eval(sm_embedding[i]) for i in first_row], dtype=np.float32)
+        embeddings = embeddings.reshape(len(compounds), drug_emb_dim)
+
+        return cls(compounds, embeddings), compound_idx.astype(np.int32)
+
+    def __len__(self):
+        return len(self.compounds) - 1
+
+    def __getitem__(self, compound_idx):
+        return torch.from_numpy(self.embeddings[compound_idx])
+
+
 class SciplexDatasetUnseenPerturbations(Dataset):
-    def __init__(self, adata_file, drug_list, dose, n_match=1, pct_treatement_negative=0, pct_dosage_negative=0):
+    def __init__(self, adata_file, drug_list, dose, n_match=1, pct_treatement_negative=0, pct_dosage_negative=0,
+                 seed=None, data_mode='memory', cache_dir=None, control_sampling='fixed'):
+        """
+        control_sampling: 'fixed' keeps the controls matched at construction, 'epoch' redraws them
+        on every resample_controls() call and 'batch' draws fresh controls whenever samples are accessed
+        """
+        if control_sampling not in ('fixed', 'epoch', 'batch'):
+            raise ValueError(f"Unsupported control sampling: {control_sampling}")
+
         self.SEP = "_"
         self.drug_list = drug_list
         self.dose = dose
@@ -20,20 +149,61 @@ class SciplexDatasetUnseenPerturbations(Dataset):
         self.pct_treatement_negative = pct_treatement_negative
         self.pct_dosage_negative = pct_dosage_negative
         self.drug_emb_dim = 256
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.control_sampling = control_sampling
+        self.rng = np.random.default_rng(seed)
+
+        # all splits built from the same file share one data source
+        if isinstance(adata_file, AnnDataSource):
+            self.source = adata_file
+        else:
+            self.source = open_data_source(adata_file, mode=data_mode)
+        self._shared_arrays = dict()
+        self.cell_types = self.source.obs['cell_type'].to_numpy()
+
+        if not self.__load_cache():
+            self.__match_control_to_treated()
+            self.add_treatement_negative()
+            self.add_dosage_negative()
+            self.__save_cache()
 
-        self.adata = ad.read_h5ad(adata_file)
-        self.data_processed = list()
-        self.__match_control_to_treated()
-        self.add_treatement_negative()
-        self.add_dosage_negative()
+        if self.control_sampling != 'fixed':
+            self.__build_control_pools()
 
     def __len__(self):
         # Return the number of samples
-        return len(self.data_processed)
+        return len(self.treated_idx)
+
+    @property
+    def adata(self):
+        return self.source.adata
+
+    def share_memory(self):
+        """
+        Move the pair index and an in-memory X into shared memory, so DataLoader workers
+        neither copy them nor miss controls resampled in the main process
+        """
+        self.source.share_memory()
+        for name in ('treated_idx', 'control_idx', 'compound_idx'):
+            if name not in self._shared_arrays:
+                self._shared_arrays[name] = torch.from_numpy(np.array(getattr(self, name))).share_memory_()
+                setattr(self, name, self._shared_arrays[name].numpy())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # numpy views are rebuilt from the shared tensors on the other side
+        for name in self._shared_arrays:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, shared in self._shared_arrays.items():
+            setattr(self, name, shared.numpy())
 
     def __match_control_to_treated(self):
-        #np.random.seed(self.seed)
-        adata = self.adata
+        obs = self.source.obs
 
         # #scale values
         # print("Scaling vals..")
@@ -41,97 +211,171 @@ class SciplexDatasetUnseenPerturbations(Dataset):
         # X_scaled = scaler.fit_transform(adata.X)
         # adata.X = X_scaled
 
-        control_A549 = adata[(adata.obs['cell_type'] == "A549") & (adata.obs['product_name'] == "Vehicle")].X
-        control_K562 = adata[ (adata.obs['cell_type'] == "K562") & (adata.obs['product_name'] == "Vehicle")].X
-        control_MCF7 = adata[ (adata.obs['cell_type'] == "MCF7") & (adata.obs['product_name'] == "Vehicle")].X
-
-        data_list = list() #list of dict object
-
-        for idx in tqdm(range(adata.n_obs)):
-            cell_meta = adata.obs.iloc[idx]
-            cell_emb = adata.X[idx]
-
-            if cell_meta['product_name'] == 'Vehicle':
-                continue
-
-            if cell_meta['product_name'] not in self.drug_list:
-                continue
-
-            if cell_meta['dose'] != self.dose:
-                continue
-
-            else:
-                matched_control = None
-                if cell_meta['cell_type'] == "A549":
-                    control_pool = control_A549
-                elif cell_meta['cell_type'] == "K562":
-                    control_pool = control_K562
-                elif cell_meta['cell_type'] == "MCF7":
-                    control_pool = control_MCF7
-                else:
-                    raise ValueError(f"Unknown cell type: {cell_meta['cell_type']}")
-
-                for i in range(self.n_match):
-
-                    # Randomly select a control cell from the relevant pool
-                    random_row_idx = np.random.choice(control_pool.shape[0])
-                    matched_control = control_pool[random_row_idx]
-
-                    #get drug embedding
-                    drug_emb = ast.literal_eval(cell_meta['sm_embedding'])
-
-
-                    #metadata
-                    meta = dict()
-                    meta['compound'] = cell_meta['product_name']
-                    meta['cell_type'] = cell_meta['cell_type']
+        # boolean masks over all cells, built in one go
+        is_vehicle = (obs['product_name'] == 'Vehicle').to_numpy()
+        is_treated = ~is_vehicle & self._select_treated(obs) & (obs['dose'] == self.dose).to_numpy()
+
+        # parse each compound embedding once, samples only keep the compound index
+        treated_rows = np.flatnonzero(is_treated)
+        self.compound_embeddings, compound_idx = CompoundEmbeddings.from_obs(obs, treated_rows,
+                                                                                self.drug_emb_dim)
+
+        # samples are (treated row, control row, compound) triplets pointing into the data source
+        self.treated_idx = np.repeat(treated_rows, self.n_match).astype(np.int32)
+        self.control_idx = match_controls(self.treated_idx, self.cell_types, is_vehicle, self.rng).astype(np.int32)
+        self.compound_idx = np.repeat(compound_idx, self.n_match)
+
+    def _select_treated(self, obs):
+        """
+        Boolean mask of the cells whose perturbation belongs to this split
+        """
+        return obs['product_name'].isin(self.drug_list).to_numpy()
+
+    def _select_controls(self, obs):
+        """
+        Boolean mask of the cells this split may draw negative pairs from (all cells by default)
+        """
+        return np.ones(len(obs), dtype=bool)
+
+    def _selection_key(self):
+        """
+        The split definition as it enters the cache key
+        """
+        return sorted(self.drug_list)
+
+    def __cache_path(self):
+        """
+        Cache directory for this dataset, keyed on the file contents and every build parameter.
+        Caching is disabled without a cache_dir or a seed, since unseeded pairings are meant to differ per run.
+        """
+        if self.cache_dir is None or self.seed is None:
+            return None
+
+        params = {
+            "file": self.source.content_hash(),
+            "dataset": f"{type(self).__module__}.{type(self).__qualname__}",
+            "selection": self._selection_key(),
+            "dose": self.dose,
+            "n_match": self.n_match,
+            "seed": self.seed,
+            "pct_treatement_negative": self.pct_treatement_negative,
+            "pct_dosage_negative": self.pct_dosage_negative,
+            "drug_emb_dim": self.drug_emb_dim,
+        }
+        key = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key)
+
+    def __load_cache(self):
+        path = self.__cache_path()
+        if path is None or not os.path.isdir(path):
+            return False
+
+        def load(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+
+        self.treated_idx = load("treated_idx")
+        self.control_idx = load("control_idx")
+        self.compound_idx = load("compound_idx")
+        self.compound_embeddings = CompoundEmbeddings(load("compounds").astype(object), load("drug_embeddings"))
+
+        print(f"Loaded matched pairs from cache {path}")
+        return True
+
+    def __save_cache(self):
+        path = self.__cache_path()
+        if path is None:
+            return
 
+        # write to a temporary directory first so an interrupted run never leaves a partial cache
+        tmp_path = path + f".tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        arrays = {
+            "treated_idx": self.treated_idx,
+            "control_idx": self.control_idx,
+            "compound_idx": self.compound_idx,
+            "compounds": self.compound_embeddings.compounds[:-1].astype(str),
+            "drug_embeddings": self.compound_embeddings.embeddings[:-1],
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name + ".npy"), array)
+
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # another process wrote the same cache in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def __build_control_pools(self):
+        """
+        Vehicle rows grouped by cell type, so controls can be redrawn without rebuilding the dataset
+        """
+        is_vehicle = (self.source.obs['product_name'] == 'Vehicle').to_numpy()
+        cell_type_names, cell_type_codes = np.unique(self.cell_types.astype(str), return_inverse=True)
+
+        vehicle_rows = np.flatnonzero(is_vehicle)
+        vehicle_codes = cell_type_codes[vehicle_rows]
+        self.control_pool_rows = vehicle_rows[np.argsort(vehicle_codes, kind='stable')].astype(np.int32)
+        self.control_pool_sizes = np.bincount(vehicle_codes, minlength=len(cell_type_names))
+        self.control_pool_offsets = np.cumsum(self.control_pool_sizes) - self.control_pool_sizes
+        self.cell_type_codes = cell_type_codes.astype(np.int32)
+
+    def __draw_controls(self, indices):
+        """
+        Draw a fresh control of the matching cell type for every sample, vectorized over indices
+        """
+        treated_idx = self.treated_idx[indices]
+        codes = self.cell_type_codes[treated_idx]
+        offsets = self.control_pool_offsets[codes]
+        sizes = self.control_pool_sizes[codes]
+        control_idx = self.control_pool_rows[offsets + (self.rng.random(len(codes)) * sizes).astype(np.int64)]
+
+        # negative pairs stay mapped onto themselves
+        negative = self.compound_idx[indices] == -1
+        control_idx[negative] = treated_idx[negative]
+
+        return control_idx
+
+    def resample_controls(self):
+        """
+        Redraw the control of every sample, e.g. once per epoch
+        """
+        if self.control_sampling == 'fixed':
+            return
 
-                    # Store the treated and matched control metadata
-                    data_list.append({
-                        "idx": idx,
-                        "treated_emb": torch.tensor(cell_emb, dtype=torch.float),
-                        "matched_control_emb": torch.tensor(matched_control, dtype=torch.float),
-                        "drug_emb": torch.tensor(drug_emb, dtype=torch.float),
-                        "meta": meta
-                    })
+        control_idx = self.__draw_controls(np.arange(len(self)))
+        if 'control_idx' in self._shared_arrays:
+            self.control_idx[:] = control_idx
+        else:
+            self.control_idx = control_idx
 
-        self.data_processed = data_list
+    def __control_idx(self, indices):
+        if self.control_sampling == 'batch':
+            return self.__draw_controls(indices)
+        return self.control_idx[indices]
 
     def add_treatement_negative(self):
         if self.pct_treatement_negative == 0:
             return
         else:
             # calculate how many negative pairs to add per cell type
-            no_examples_to_add_total = round(self.pct_treatement_negative * len(self.data_processed))
-            no_examples_to_add_per_celltype = round(no_examples_to_add_total/3)
-
-            control_A549 = adata[(adata.obs['cell_type'] == "A549") & (adata.obs['product_name'] == "Vehicle")].X
-            control_K562 = adata[(adata.obs['cell_type'] == "K562") & (adata.obs['product_name'] == "Vehicle")].X
-            control_MCF7 = adata[(adata.obs['cell_type'] == "MCF7") & (adata.obs['product_name'] == "Vehicle")].X
-
-            control_pools = [control_A549, control_K562, control_MCF7]
+            obs = self.source.obs
+            is_vehicle = (obs['product_name'] == 'Vehicle').to_numpy() & self._select_controls(obs)
+            cell_types = np.unique(self.cell_types[is_vehicle])
 
-            data_list_negative = list()
+            no_examples_to_add_total = round(self.pct_treatement_negative * len(self))
+            no_examples_to_add_per_celltype = round(no_examples_to_add_total / len(cell_types))
 
-            idx = 10000000
+            # negative pairs map a random vehicle cell onto itself with the zero drug embedding
+            negative_rows = list()
+            for cell_type in cell_types:
+                control_pool = np.flatnonzero(is_vehicle & (self.cell_types == cell_type))
+                negative_rows.append(self.rng.choice(control_pool, no_examples_to_add_per_celltype))
+            negative_rows = np.concatenate(negative_rows)
 
-            #for each cell type, add negative pairs
-            for control in control_pools:
-                cell_type = list(control.obs['cell_type'].unique())[0]
-                for x in range(no_examples_to_add_per_celltype):
-                    random_control = control[np.random.choice(control.shape[0])]
-                    idx += 1
-
-                    data_list_negative.append({
-                        "idx": idx,
-                        "treated_emb": torch.tensor(random_control, dtype=torch.float),
-                        "matched_control_emb": torch.tensor(random_control, dtype=torch.float),
-                        "drug_emb": torch.zeros(self.drug_emb_dim),
-                        "meta": {"compound": None, "cell_type": cell_type }
-                    })
-
-            self.data_processed.extend(data_list_negative)
+            self.treated_idx = np.concatenate([self.treated_idx, negative_rows]).astype(np.int32)
+            self.control_idx = np.concatenate([self.control_idx, negative_rows]).astype(np.int32)
+            self.compound_idx = np.concatenate([self.compound_idx,
+                                                np.full(len(negative_rows), -1, dtype=np.int32)])
 
     def add_dosage_negative(self):
         if self.pct_dosage_negative == 0:
@@ -142,12 +386,32 @@ class SciplexDatasetUnseenPerturbations(Dataset):
 
 
     def __getitem__(self, idx):
-        val = self.data_processed[idx]
-
-        #concatenate control, drug embedding,
-        control_emb = val['matched_control_emb']
-        drug_emb = val['drug_emb']
-        treated_emb = val['treated_emb']
-        meta = val['meta']
-
-        return control_emb, drug_emb, treated_emb, meta
\ No newline at end of file
+        compound_idx = self.compound_idx[idx]
+
+        #gather control, drug and treated embeddings from the shared data source
+        control_emb = torch.from_numpy(self.source.take(self.__control_idx(np.array([idx]))[0]))
+        drug_emb = self.compound_embeddings[compound_idx]
+        treated_emb = torch.from_numpy(self.source.take(self.treated_idx[idx]))
+        meta = {"compound": self.compound_embeddings.compounds[compound_idx],
+                "cell_type": self.cell_types[self.treated_idx[idx]],
+                "compound_idx": compound_idx}
+
+        return control_emb, drug_emb, treated_emb, meta
+
+    def __getitems__(self, indices):
+        """
+        Batched access: gathers the whole batch with one fancy-indexing operation per matrix
+        and returns stacked tensors plus array-based meta
+        """
+        indices = np.asarray(indices)
+        treated_idx = self.treated_idx[indices]
+        compound_idx = self.compound_idx[indices]
+
+        control_emb = torch.from_numpy(self.source.take(self.__control_idx(indices)))
+        drug_emb = torch.from_numpy(self.compound_embeddings.embeddings[compound_idx])
+        treated_emb = torch.from_numpy(self.source.take(treated_idx))
+        meta = {"compound": self.compound_embeddings.compounds[compound_idx],
+                "cell_type": self.cell_types[treated_idx],
+                "compound_idx": compound_idx}
+
+        return control_emb, drug_emb, treated_emb, meta
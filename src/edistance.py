@@ -0,0 +1,189 @@
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from sklearn.metrics import pairwise_distances
+
+
+def _mean(X, chunk_size=None):
+    """
+    Row mean of X accumulated in float64, optionally in chunks of rows
+    (for memory-mapped or on-disk matrices that should not be loaded at once)
+    """
+    if chunk_size is None:
+        return np.asarray(X).mean(axis=0, dtype=np.float64)
+
+    total = np.zeros(X.shape[1], dtype=np.float64)
+    for start in range(0, X.shape[0], chunk_size):
+        total += np.asarray(X[start:start + chunk_size]).sum(axis=0, dtype=np.float64)
+    return total / X.shape[0]
+
+
+def calculate_edistance(X, Y, chunk_size=None):
+    """
+    Calculate the E-distance between two matrices in O(n·d).
+
+    With squared Euclidean distances, 2 * mean d(X, Y) - mean d(X, X) - mean d(Y, Y) (means over the
+    full pairwise matrices) reduces exactly to 2 * ||mean(X) - mean(Y)||², so no pairwise matrix is built.
+    Means are accumulated in float64; chunk_size bounds the rows read at once.
+    """
+    diff = _mean(X, chunk_size) - _mean(Y, chunk_size)
+    return 2 * float(diff @ diff)
+
+
+def segment_means(X, offsets):
+    """
+    Means of the contiguous row segments X[offsets[i]:offsets[i + 1]] with one np.add.reduceat,
+    accumulated in float64. Empty segments are NaN.
+    """
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    means = np.full((len(counts), X.shape[1]), np.nan)
+
+    non_empty = counts > 0
+    if non_empty.any():
+        sums = np.add.reduceat(np.asarray(X), offsets[:-1][non_empty], axis=0, dtype=np.float64)
+        means[non_empty] = sums / counts[non_empty, None]
+
+    return means
+
+
+def group_rows(*columns):
+    """
+    Group rows by the given key columns with one stable argsort.
+    Returns the row order, the segment offsets into that order and the key tuple of every group.
+    Groups follow the order of first appearance of each key; rows with a missing key are left out.
+    """
+    codes, uniques = zip(*[pd.factorize(np.asarray(column)) for column in columns])
+    codes = np.vstack(codes)
+    dims = tuple(len(u) for u in uniques)
+
+    rows = np.flatnonzero((codes >= 0).all(axis=0))
+    if len(rows) == 0:
+        return rows, np.zeros(1, dtype=np.int64), list()
+
+    combined = np.ravel_multi_index(codes[:, rows], dims)
+    order = np.argsort(combined, kind='stable')
+    combined = combined[order]
+
+    offsets = np.concatenate([[0], np.flatnonzero(np.diff(combined)) + 1, [len(rows)]])
+    group_codes = np.unravel_index(combined[offsets[:-1]], dims)
+    keys = list(zip(*[u[c] for u, c in zip(uniques, group_codes)]))
+
+    return rows[order], offsets, keys
+
+
+def group_means(X, labels, n_groups=None):
+    """
+    Means of the rows of X grouped by integer labels, via one argsort and a segment mean
+    """
+    labels = np.asarray(labels)
+    if n_groups is None:
+        n_groups = labels.max() + 1 if len(labels) else 0
+
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels, minlength=n_groups)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    return segment_means(np.asarray(X)[order], offsets)
+
+
+def calculate_edistances(X, x_labels, Y, y_labels, n_groups=None):
+    """
+    Batched E-distance: for every group g, the E-distance between X[x_labels == g] and Y[y_labels == g],
+    computed for all groups in one call. Groups missing from either side are NaN.
+    """
+    if n_groups is None:
+        n_groups = max(np.max(x_labels, initial=-1), np.max(y_labels, initial=-1)) + 1
+
+    diff = group_means(X, x_labels, n_groups) - group_means(Y, y_labels, n_groups)
+    return 2 * (diff ** 2).sum(axis=1)
+
+
+def _pairwise_sums(A, B, weights_a, weights_b, metric, chunk_size):
+    """
+    Sum of the pairwise distance matrix d(A, B) and its sums under bootstrap multiplicities
+    (weights_a @ D @ weights_b, one per replicate), built chunk_size rows of A at a time.
+    Within a group the diagonal is zero, so pairs of the same draw drop out (U-statistic).
+    """
+    total = 0.0
+    weighted = np.zeros(len(weights_a))
+    for start in range(0, len(A), chunk_size):
+        D = pairwise_distances(A[start:start + chunk_size], B, metric=metric)
+        total += D.sum()
+        weighted += ((weights_a[:, start:start + chunk_size] @ D) * weights_b).sum(axis=1)
+    return total, weighted
+
+
+def sampled_edistance(X, Y, metric='euclidean', n_samples=1000, n_bootstrap=200, confidence=0.95,
+                      tol=None, max_samples=None, seed=None, chunk_size=1024):
+    """
+    Approximate E-distance 2 * mean d(X, Y) - mean d(X, X) - mean d(Y, Y) for a general metric
+    (Euclidean by default, i.e. the energy distance) from a random subsample of each group.
+
+    The within-group terms are U-statistics rescaled by (1 - 1/n), so the estimate is unbiased for the
+    full-data value and exact once the subsample covers both groups. Bootstrap replicates of the
+    subsample give the standard error and a percentile confidence interval. With tol, the subsample
+    is doubled until the interval half-width is at most tol or max_samples rows are reached (default
+    4 * n_samples, bounded by the group sizes). If tol is not met within that cap, tol_met is False and
+    a warning is issued. The pairwise matrices are never held whole: they are streamed in chunk_size-row
+    blocks, so memory stays at O(chunk_size * max_samples) while time grows with max_samples².
+    With metric='sqeuclidean' the exact closed form (calculate_edistance) is returned instead.
+
+    Returns a dict with estimate, std, variance, ci, n_samples (rows used per group), tol_met and
+    runtime (s).
+    """
+    start_time = time.perf_counter()
+    n_x, n_y = len(X), len(Y)
+    if n_x < 2 or n_y < 2:
+        raise ValueError("sampled_edistance needs at least two rows per group")
+
+    if metric == 'sqeuclidean':
+        return {"estimate": calculate_edistance(X, Y), "std": 0.0, "variance": 0.0, "ci": (None, None),
+                "n_samples": (n_x, n_y), "tol_met": True, "runtime": time.perf_counter() - start_time}
+
+    rng = np.random.default_rng(seed)
+    if max_samples is None:
+        max_samples = min(max(n_x, n_y), 4 * n_samples)
+    alpha = (1 - confidence) / 2
+
+    m = min(n_samples, max_samples)
+    while True:
+        m_x, m_y = min(m, n_x), min(m, n_y)
+        X_sample = np.asarray(X[np.sort(rng.choice(n_x, m_x, replace=False))], dtype=np.float64)
+        Y_sample = np.asarray(Y[np.sort(rng.choice(n_y, m_y, replace=False))], dtype=np.float64)
+
+        # bootstrap over the subsample via multiplicity weights, all replicates in a few matmuls per chunk
+        weights_x = np.stack([np.bincount(rng.integers(0, m_x, m_x), minlength=m_x) for _ in range(n_bootstrap)])
+        weights_y = np.stack([np.bincount(rng.integers(0, m_y, m_y), minlength=m_y) for _ in range(n_bootstrap)])
+        weights_x, weights_y = weights_x.astype(np.float64), weights_y.astype(np.float64)
+
+        sum_xy, boot_xy = _pairwise_sums(X_sample, Y_sample, weights_x, weights_y, metric, chunk_size)
+        sum_xx, boot_xx = _pairwise_sums(X_sample, X_sample, weights_x, weights_x, metric, chunk_size)
+        sum_yy, boot_yy = _pairwise_sums(Y_sample, Y_sample, weights_y, weights_y, metric, chunk_size)
+
+        # rescale the unbiased within-group means to the full-matrix (diagonal included) convention
+        scale_x, scale_y = 1 - 1 / n_x, 1 - 1 / n_y
+        estimate = (2 * sum_xy / (m_x * m_y)
+                    - scale_x * sum_xx / (m_x * (m_x - 1))
+                    - scale_y * sum_yy / (m_y * (m_y - 1)))
+        replicates = (2 * boot_xy / (m_x * m_y)
+                      - scale_x * boot_xx / (m_x * (m_x - 1))
+                      - scale_y * boot_yy / (m_y * (m_y - 1)))
+
+        std = float(replicates.std(ddof=1))
+        # percentile interval of the replicates, recentred on the estimate
+        low, high = np.quantile(replicates - replicates.mean(), [alpha, 1 - alpha]) + estimate
+
+        covered = m_x == n_x and m_y == n_y
+        tol_met = tol is None or (high - low) / 2 <= tol or covered
+        if tol_met or m >= max_samples:
+            break
+        m = min(2 * m, max_samples)
+
+    if not tol_met:
+        warnings.warn(f"sampled_edistance: interval half-width {(high - low) / 2:.4g} above tol={tol} "
+                      f"at the max_samples cap ({max_samples} rows)")
+
+    return {"estimate": float(estimate), "std": std, "variance": std ** 2, "ci": (float(low), float(high)),
+            "n_samples": (m_x, m_y), "tol_met": tol_met, "runtime": time.perf_counter() - start_time}
@@ -21,8 +21,11 @@ from tqdm import tqdm
 from sklearn.model_selection import train_test_split
 import torch.nn.functional as F
 
-from model import FiLMModel
-from dataset import SciplexDatasetUnseenPerturbations
+from model import FiLMModel, GammaCache
+from dataset import SciplexDatasetUnseenPerturbations, BatchIndexSampler, collate_batch, init_worker
+from tensor_store import TensorStore
+from results import TestResults, StreamingResultsWriter, load_results
+from metrics import get_stats
 
 def loss_fn(pred, target, control):
     # L1 loss (primary term)
@@ -35,28 +38,77 @@ def loss_fn(pred, target, control):
     return l1_loss + 0.3 * cos_loss
 
 
+class LossTracker():
+    """
+    On-device loss history: every update writes the detached loss into a preallocated tensor and a
+    running sum, so the training loop never waits on the device; values are only copied to the host
+    when they are logged or read back.
+    """
+
+    def __init__(self, capacity, device):
+        self.history = torch.zeros(max(1, capacity), device=device)
+        self.n = 0
+        self.running_sum = torch.zeros((), device=device)
+        self.running_count = 0
+
+    def update(self, loss):
+        if self.n == len(self.history):
+            # grow by doubling when the step count was underestimated
+            self.history = torch.cat([self.history, torch.zeros_like(self.history)])
+        loss = loss.detach()
+        self.history[self.n] = loss
+        self.running_sum += loss
+        self.running_count += 1
+        self.n += 1
+
+    def __len__(self):
+        return self.n
+
+    def last(self):
+        return self.history[self.n - 1].item()
+
+    def mean(self, reset=True):
+        """
+        Mean of the losses since the last reset (one host sync)
+        """
+        value = (self.running_sum / max(1, self.running_count)).item()
+        if reset:
+            self.running_sum.zero_()
+            self.running_count = 0
+        return value
+
+    def to_numpy(self):
+        return self.history[:self.n].cpu().numpy()
+
+
+def merge_config(config, overrides):
+    """
+    Copy of config with the (nested) values of overrides replacing its own
+    """
+    merged = dict(config)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
 class FiLMModelEvaluator():
 
-    def __init__(self, config_path, model, sciplex_dataset_train, sciplex_dataset_validation, sciplex_dataset_test):
+    def __init__(self, config_path, model, sciplex_dataset_train, sciplex_dataset_validation, sciplex_dataset_test,
+                 config_overrides=None):
         # load config file
         self.__read_config(config_path)
+        if config_overrides:
+            self.config = merge_config(self.config, config_overrides)
 
         #prepare model
         self.__prepare_model(model)
 
-        self.sciplex_loader_train = DataLoader(sciplex_dataset_train,
-                                               batch_size=self.config['train_params']['batch_size'],
-                                               shuffle=True,
-                                               num_workers=0)
-
-        self.sciplex_loader_validation = DataLoader(sciplex_dataset_validation,
-                                               batch_size=self.config['train_params']['batch_size'],
-                                               shuffle=True,
-                                               num_workers=0)
-
-        self.sciplex_loader_test = DataLoader(sciplex_dataset_test,
-                                              batch_size=self.config['train_params']['batch_size'],
-                                              shuffle=True, num_workers=0)
+        self.sciplex_loader_train = self.__make_loader(sciplex_dataset_train, shuffle=True)
+        self.sciplex_loader_validation = self.__make_loader(sciplex_dataset_validation, shuffle=True)
+        self.sciplex_loader_test = self.__make_loader(sciplex_dataset_test, shuffle=True)
 
     def __read_config(self, config_path):
         with open(config_path, 'r') as file:
@@ -68,31 +120,90 @@ class FiLMModelEvaluator():
 
 
 
+    def __make_loader(self, dataset, shuffle):
+        batch_size = self.config['train_params']['batch_size']
+        loader_params = self.config.get('loader_params', dict())
+
+        num_workers = loader_params.get('num_workers', 0)
+        loader_kwargs = {"num_workers": num_workers,
+                         "pin_memory": loader_params.get('pin_memory', False)}
+        if num_workers > 0:
+            loader_kwargs.update({"prefetch_factor": loader_params.get('prefetch_factor', 2),
+                                  "persistent_workers": loader_params.get('persistent_workers', False),
+                                  "worker_init_fn": init_worker})
+            if hasattr(dataset, 'share_memory'):
+                dataset.share_memory()
+
+        if hasattr(dataset, '__getitems__'):
+            # batched fast path: one index array per batch, stacked by the dataset itself
+            batch_sampler = BatchIndexSampler(len(dataset), batch_size, shuffle=shuffle)
+            return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_batch, **loader_kwargs)
+
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **loader_kwargs)
+
     def __prepare_model(self, model):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        train_params = self.config['train_params']
         self.model = model(self.config)
-        self.optimizer = optim.Adam(self.model.parameters(),
-                                    lr=self.config['train_params']['lr'],
-                                    weight_decay=self.config['train_params']['weight_decay'])
+        self.model = self.model.to(self.device)
+
+        optimizer_kwargs = {"lr": train_params['lr'], "weight_decay": train_params['weight_decay']}
+        try:
+            self.optimizer = optim.Adam(self.model.parameters(), fused=train_params.get('fused_optimizer', False),
+                                        **optimizer_kwargs)
+        except RuntimeError as exc:
+            print("Fused Adam not available, using the default implementation:", exc)
+            self.optimizer = optim.Adam(self.model.parameters(), **optimizer_kwargs)
         self.criterion = nn.L1Loss()
 
-        self.model = self.model.to(self.device)
+        # mixed precision: forward passes run under bf16 autocast, losses and results are kept in fp32
+        autocast = train_params.get('autocast')
+        if autocast not in (None, 'bf16'):
+            raise ValueError(f"Unsupported autocast mode: {autocast}")
+        self.autocast = autocast == 'bf16'
+
+        # compiled forward; self.model keeps the plain module (and its state_dict keys)
+        compile_mode = train_params.get('compile')
+        self.forward_model = torch.compile(self.model, mode=compile_mode) if compile_mode else self.model
+
+    def __autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.autocast)
 
     def train(self):
         print("Begin training ...")
         self.model.train()  # Set the model to training mode
-        losses = []
 
         num_epochs = self.config['train_params']['num_epochs']
         device = self.device  # Target device (e.g., 'cuda' or 'cpu')
+        losses = LossTracker(num_epochs * len(self.sciplex_loader_train), device)
 
         iteration = 0
-        every_n = 10
+        validation_params = self.config.get('validation_params', dict())
+        every_n_steps = validation_params.get('every_n_steps', 10)
+        every_n_epochs = validation_params.get('every_n_epochs')
+        # nothing is gathered when no validation schedule is set
+        validation_data = None
+        if every_n_steps or every_n_epochs:
+            validation_data = self.__prepare_validation(validation_params)
+
+        # tensor store mode: the training pairs live on the device and batches are gathered there
+        train_data = self.sciplex_loader_train.dataset
+        if self.config['train_params'].get('tensor_store', False):
+            train_data = TensorStore(train_data, device)
 
         for epoch in range(num_epochs):
             print(f"Epoch {epoch + 1}/{num_epochs}")
 
-            for control_emb, drug_emb, treated_emb, meta in self.sciplex_loader_train:
+            # fresh control pairings every epoch for datasets in 'epoch' control sampling mode
+            if epoch > 0 and hasattr(train_data, 'resample_controls'):
+                train_data.resample_controls()
+
+            if isinstance(train_data, TensorStore):
+                train_batches = train_data.batches(self.config['train_params']['batch_size'])
+            else:
+                train_batches = self.sciplex_loader_train
+
+            for control_emb, drug_emb, treated_emb, meta in train_batches:
                 # Move tensors to the specified device
                 control_emb = control_emb.to(device)
                 drug_emb = drug_emb.to(device)
@@ -102,11 +213,12 @@ class FiLMModelEvaluator():
                 self.optimizer.zero_grad()
 
                 # Forward pass through the model
-                output = self.model(control_emb, drug_emb)
+                with self.__autocast():
+                    output = self.forward_model(control_emb, drug_emb)
 
                 # Compute the loss
                 #loss = self.criterion(output, treated_emb)
-                loss = loss_fn(output, treated_emb, control_emb)
+                loss = loss_fn(output.float(), treated_emb, control_emb)
 
                 # Backpropagation
                 loss.backward()
@@ -114,55 +226,117 @@ class FiLMModelEvaluator():
                 # Update model parameters
                 self.optimizer.step()
 
-                # Track the loss
-                losses.append(loss.item())
+                # Track the loss (on the device, synced only when logged)
+                losses.update(loss)
 
                 iteration += 1
 
-                #############VALIDATION LOOP#################
+                if every_n_steps and iteration % every_n_steps == 0:
+                    print("Iteration:", iteration, "Test Loss:", losses.last(),
+                          "Avg. Validation Loss:", self.__validate(validation_data))
 
-                if iteration % every_n == 0:
+            if every_n_epochs and (epoch + 1) % every_n_epochs == 0:
+                print("Epoch:", epoch + 1, "Avg. Validation Loss:", self.__validate(validation_data))
 
+        self.losses_train = losses.to_numpy()
+        self.trained_model = self.model
+
+        print("Training completed.")
 
-                    validation_losses = list()
-                    with torch.no_grad():
-                        for control_emb, drug_emb, treated_emb, meta in self.sciplex_loader_validation:
-                            control_emb, drug_emb, treated_emb = (
-                                control_emb.to(device),
-                                drug_emb.to(device),
-                                treated_emb.to(device),
-                            )
+    def __prepare_validation(self, validation_params):
+        """
+        Validation data for the run. With cache (default), the validation pairs are stacked once into
+        device tensors, optionally restricted to a fixed random subsample (a number of pairs or a
+        fraction); the tensors hold device memory for the whole of train(), so large validation sets
+        should be subsampled or use cache: false, where the validation loader is used instead (cut to
+        the same number of pairs).
+        """
+        dataset = self.sciplex_loader_validation.dataset
+        n = len(dataset)
 
-                            # Forward pass
-                            output_validation = self.model(control_emb, drug_emb)
+        subsample = validation_params.get('subsample')
+        if subsample is not None:
+            n = min(n, int(subsample * n) if isinstance(subsample, float) else subsample)
 
-                            # Compute loss
-                            validation_loss = loss_fn(output_validation, treated_emb, control_emb)
+        if not validation_params.get('cache', True):
+            return n
 
-                            # Track validation loss
-                            validation_losses.append(validation_loss.item())
+        store = TensorStore(dataset, self.device)
+        idx = torch.randperm(len(store), device=self.device)[:n] if n < len(store) else None
+        return store.stacked(idx)
 
+    def __validate(self, validation_data):
+        """
+        Average validation loss over batches, in eval mode and without autograd tracking
+        """
+        batch_size = self.config['train_params']['batch_size']
+        validation_losses = LossTracker(0, self.device)
+
+        self.model.eval()
+        with torch.inference_mode():
+            if isinstance(validation_data, tuple):
+                batches = zip(*[tensor.split(batch_size) for tensor in validation_data])
+            else:
+                batches = ((control_emb.to(self.device), drug_emb.to(self.device), treated_emb.to(self.device))
+                           for control_emb, drug_emb, treated_emb, meta in self.sciplex_loader_validation)
+
+            n_seen = 0
+            for control_emb, drug_emb, treated_emb in batches:
+                with self.__autocast():
+                    output_validation = self.forward_model(control_emb, drug_emb)
+                validation_losses.update(loss_fn(output_validation.float(), treated_emb, control_emb))
+
+                n_seen += len(control_emb)
+                if not isinstance(validation_data, tuple) and n_seen >= validation_data:
+                    break
+        self.model.train()
+
+        return validation_losses.mean()
+
+    def test(self, save_path=None, stream_path=None, compression=None):
+        """
+        Test the FiLMResidualModel and collect results.
+        With stream_path, every batch is appended to an HDF5 file instead of kept in memory, and the
+        E-distance statistics are computed online (self.test_stats); the stream file takes the place of
+        save_path, so the two cannot be combined.
+        """
+        if stream_path and save_path:
+            raise ValueError("stream_path already stores the results, save_path cannot be used with it")
 
-                    print("Iteration:", iteration, "Test Loss:", loss.item(), "Avg. Validation Loss:", np.mean(validation_losses))
+        self.trained_model.eval()  # Set the model to evaluation mode
 
-                #############VALIDATION LOOP#################
+        if stream_path:
+            # the writer is closed (and its categories written) even if testing fails halfway
+            with StreamingResultsWriter(stream_path, compression=compression) as results:
+                self.__predict(results)
+            self.test_stats = results.model_stats()
+            self.test_results = None
+            self.test_results_path = stream_path
+            print(f"Testing completed. Results streamed to {stream_path}, statistics stored in 'self.test_stats'.")
+            return
+
+        # batches are written straight into preallocated columnar buffers
+        results = TestResults(len(self.sciplex_loader_test.dataset))
+        self.__predict(results)
+        self.test_results = results
 
-        self.losses_train = losses
-        self.trained_model = self.model
+        print("Testing completed. Results stored in 'self.test_results'.")
 
-        print("Training completed.")
+        # Save to file if save_path is provided
+        if save_path:
+            self.save_results(save_path)
 
-    def test(self, save_path=None):
+    def __predict(self, results):
         """
-        Test the FiLMResidualModel and collect results.
+        Run the trained model over the test loader and append every batch to results
         """
-        control_embeddings = []
-        treated_embeddings = []
-        model_output = []
-        compounds_list = []
-        cell_types_list = []
-
-        self.trained_model.eval()  # Set the model to evaluation mode
+        # per-compound gamma cache: rows of an already seen compound skip the conditioning network
+        inference_params = self.config.get('inference_params', dict())
+        gamma_cache = None
+        if inference_params.get('gamma_cache', False) and hasattr(self.trained_model, 'compute_gammas'):
+            if getattr(self, 'gamma_cache', None) is None:
+                self.gamma_cache = GammaCache(self.trained_model, inference_params.get('gamma_cache_size'))
+            gamma_cache = self.gamma_cache
 
         with torch.no_grad():  # Disable gradient computation
             for control_emb, drug_emb, treated_emb, meta in tqdm(self.sciplex_loader_test):
@@ -172,63 +346,49 @@ class FiLMModelEvaluator():
                 treated_emb = treated_emb.to(self.device)
 
                 # Forward pass through the model
-                output = self.trained_model(control_emb, drug_emb)
-
-                # Convert tensors to lists of NumPy arrays for DataFrame compatibility
-                control_emb_list = [x.cpu().numpy() for x in torch.unbind(control_emb, dim=0)]
-                treated_emb_list = [x.cpu().numpy() for x in torch.unbind(treated_emb, dim=0)]
-                output_list = [x.cpu().numpy() for x in torch.unbind(output, dim=0)]
-
-                # Meta information
-                compounds = meta['compound']
-                cell_types = meta['cell_type']
-
-                # Append results to lists
-                control_embeddings.extend(control_emb_list)
-                treated_embeddings.extend(treated_emb_list)
-                model_output.extend(output_list)
-                compounds_list.extend(compounds)
-                cell_types_list.extend(cell_types)
-
-        # Save results into a DataFrame
-        self.test_results = pd.DataFrame({
-            "ctrl_emb": control_embeddings,
-            "pert_emb": treated_embeddings,
-            "pred_emb": model_output,
-            "compound": compounds_list,
-            "cell_type": cell_types_list,
-        })
+                with self.__autocast():
+                    if gamma_cache is not None:
+                        gammas = gamma_cache.gammas(meta['compound_idx'], drug_emb)
+                        output = self.forward_model(control_emb, drug_emb, gammas=gammas).float()
+                    else:
+                        output = self.forward_model(control_emb, drug_emb).float()
 
-        print("Testing completed. Results stored in 'self.test_results'.")
+                results.append(control_emb, treated_emb, output, meta['compound'], meta['cell_type'])
 
-        # Save to file if save_path is provided
-        if save_path:
-            self.save_results(save_path)
-
-    def save_results(self, save_path):
+    def save_results(self, save_path, dtype=np.float32, compression=None):
         """
-        Saves test results to a file. Supports multiple formats (CSV, JSON, Pickle).
+        Saves test results to a file. Supports multiple formats (CSV, JSON, Pickle) and the binary
+        formats of TestResults.save (npz, h5/hdf5), which load_results reads back without parsing.
+        dtype and compression only apply to the binary formats.
         """
         file_extension = save_path.split('.')[-1]
 
-        if file_extension == 'csv':
+        if file_extension in ('npz', 'h5', 'hdf5'):
+            self.test_results.save(save_path, dtype=dtype, compression=compression)
+        elif file_extension == 'csv':
             # Convert embeddings to lists for CSV compatibility
-            df_to_save = self.test_results.copy()
+            df_to_save = self.test_results.to_frame()
             df_to_save['ctrl_emb'] = df_to_save['ctrl_emb'].apply(list)
             df_to_save['pert_emb'] = df_to_save['pert_emb'].apply(list)
             df_to_save['pred_emb'] = df_to_save['pred_emb'].apply(list)
             df_to_save.to_csv(save_path, index=False)
         elif file_extension == 'json':
             # Save to JSON
-            self.test_results.to_json(save_path, orient='records')
+            self.test_results.to_frame().to_json(save_path, orient='records')
         elif file_extension == 'pkl':
             # Save to Pickle for preserving object types like tensors
-            self.test_results.to_pickle(save_path)
+            self.test_results.to_frame().to_pickle(save_path)
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
 
         print(f"Results saved to {save_path}.")
 
+    def get_stats(self, metric='euclidean'):
+        """
+        Print PCP, PR (when doses are available) and loss on the test results, see metrics.py
+        """
+        get_stats(self.get_test_results(), metric)
+
     def plot_training_loss(self):
         plt.figure(figsize=(8, 6))
         index_losses = list(range(len(self.losses_train)))
@@ -240,4 +400,7 @@ class FiLMModelEvaluator():
 
 
     def get_test_results(self):
+        if self.test_results is None:
+            # streamed results are only read back on request
+            return load_results(self.test_results_path)
         return self.test_results
\ No newline at end of file
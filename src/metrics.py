@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+from edistance import group_rows, segment_means
+from utils import get_embeddings
+
+
+def rowwise_distance(A, B, metric='euclidean'):
+    """
+    Distance between every row of A and the matching row of B.
+    metric is one of 'euclidean', 'sqeuclidean', 'cityblock' or 'cosine' (vectorized), or a
+    callable on two vectors (the old dist_func), which is then applied pair by pair.
+    """
+    if callable(metric):
+        return np.array([metric(a, b) for a, b in zip(A, B)], dtype=np.float64)
+
+    A = np.asarray(A, dtype=np.float64)
+    B = np.asarray(B, dtype=np.float64)
+
+    if metric == 'euclidean':
+        return np.sqrt(((A - B) ** 2).sum(axis=1))
+    if metric == 'sqeuclidean':
+        return ((A - B) ** 2).sum(axis=1)
+    if metric == 'cityblock':
+        return np.abs(A - B).sum(axis=1)
+    if metric == 'cosine':
+        return 1 - (A * B).sum(axis=1) / (np.linalg.norm(A, axis=1) * np.linalg.norm(B, axis=1))
+
+    raise ValueError(f"Unsupported metric: {metric}")
+
+
+def _column(results, name):
+    """
+    A metadata column of a results DataFrame or TestResults container, None if missing
+    """
+    columns = results.columns if isinstance(results, pd.DataFrame) else results.obs.columns
+    if name not in columns:
+        return None
+    return np.asarray(results[name])
+
+
+def group_centroids(results, *keys):
+    """
+    Centroids of the control, perturbed and predicted embeddings of every group of rows sharing the
+    given metadata keys, from one sort and one segment mean per matrix.
+    Returns the group keys and the three (n_groups, dim) centroid matrices.
+    """
+    order, offsets, group_keys = group_rows(*[_column(results, key) for key in keys])
+
+    centroids = [segment_means(get_embeddings(results, column, order), offsets)
+                 for column in ('ctrl_emb', 'pert_emb', 'pred_emb')]
+
+    return group_keys, centroids
+
+
+def _stratify(values, cell_types):
+    """
+    Mean of values per cell type
+    """
+    cell_types = np.asarray(cell_types)
+    return {str(cell_type): np.mean(values[cell_types == cell_type]) for cell_type in pd.unique(cell_types)}
+
+
+def get_PCP(results, metric='euclidean'):
+    """
+    Get PCP (procentage closer to perturb): per cell type, the fraction of compound (x dose) groups whose
+    predicted centroid is not closer to the reference centroid than to the perturbed one
+    """
+    keys = ('cell_type', 'compound', 'dose') if _column(results, 'dose') is not None else ('cell_type', 'compound')
+    group_keys, (centroid_reference, centroid_perturbed, centroid_predicted) = group_centroids(results, *keys)
+
+    closer_to_reference = (rowwise_distance(centroid_reference, centroid_predicted, metric)
+                           < rowwise_distance(centroid_perturbed, centroid_predicted, metric))
+
+    return _stratify(~closer_to_reference, [key[0] for key in group_keys])
+
+
+def average_ranks(Y):
+    """
+    Ranks (1-based) along the last axis with ties sharing their average rank. NaN entries are left
+    out of the ranking and stay NaN. Meant for short rows such as a handful of doses: the ranks come
+    from one (n, k, k) comparison instead of a sort per row.
+    """
+    Y = np.asarray(Y, dtype=np.float64)
+    less = (Y[..., None, :] < Y[..., :, None]).sum(axis=-1)
+    equal = (Y[..., None, :] == Y[..., :, None]).sum(axis=-1)
+    return np.where(np.isnan(Y), np.nan, less + (equal + 1) / 2)
+
+
+def spearman_rows(Y, x=None):
+    """
+    Spearman correlation between x and every row of a (n_groups, n_doses) matrix Y, in one call.
+
+    Ties get average ranks and the correlation is the Pearson correlation of the ranks, which without
+    ties equals the closed form 1 - 6 * sum(d²) / (m * (m² - 1)). NaN entries (e.g. untested doses)
+    are left out per row, so each row is ranked over the doses it has. Rows with fewer than two values
+    or constant ranks are NaN, as with scipy.stats.spearmanr. x defaults to the column order.
+    Accepts numpy arrays or (detached) torch tensors, so it can be used as a validation metric.
+    """
+    if hasattr(Y, 'detach'):
+        Y = Y.detach().cpu().numpy()
+    Y = np.atleast_2d(np.asarray(Y, dtype=np.float64))
+    if x is None:
+        x = np.arange(Y.shape[1])
+
+    # rank x only over the positions present in each row
+    X = np.where(np.isnan(Y), np.nan, np.broadcast_to(np.asarray(x, dtype=np.float64), Y.shape))
+    rank_x = average_ranks(X)
+    rank_y = average_ranks(Y)
+
+    present = ~np.isnan(Y)
+    count = present.sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rank_x = np.where(present, rank_x - np.nansum(rank_x, axis=1, keepdims=True) / count, 0)
+        rank_y = np.where(present, rank_y - np.nansum(rank_y, axis=1, keepdims=True) / count, 0)
+
+        correlations = (rank_x * rank_y).sum(axis=1) / np.sqrt((rank_x ** 2).sum(axis=1) * (rank_y ** 2).sum(axis=1))
+
+    return np.where(count[:, 0] >= 2, correlations, np.nan)
+
+
+def get_PR(results, metric='euclidean'):
+    """
+    Get PR (prediction robustness), which measures the spearman correlation between dose and distance to control
+    """
+    # reference centroid over all doses of a compound, perturbed/predicted centroids per dose
+    compound_keys, (centroid_reference, _, _) = group_centroids(results, 'cell_type', 'compound')
+    dose_keys, (_, centroid_perturbed, centroid_predicted) = group_centroids(results, 'cell_type', 'compound', 'dose')
+
+    compound_index = {key: i for i, key in enumerate(compound_keys)}
+    rows = np.array([compound_index[key[:2]] for key in dose_keys])
+    doses = np.array(sorted({key[2] for key in dose_keys}))
+    columns = np.searchsorted(doses, [key[2] for key in dose_keys])
+
+    # (n_compound_groups, n_doses) distance matrices, NaN where a dose was not tested
+    distances_perturbed = np.full((len(compound_keys), len(doses)), np.nan)
+    distances_predicted = np.full((len(compound_keys), len(doses)), np.nan)
+    distances_perturbed[rows, columns] = rowwise_distance(centroid_reference[rows], centroid_perturbed, metric)
+    distances_predicted[rows, columns] = rowwise_distance(centroid_reference[rows], centroid_predicted, metric)
+
+    cell_types = [key[0] for key in compound_keys]
+    results_perturbed = _stratify(spearman_rows(distances_perturbed, doses), cell_types)
+    results_predicted = _stratify(spearman_rows(distances_predicted, doses), cell_types)
+
+    return results_perturbed, results_predicted
+
+
+def get_validation_loss(results, metric='euclidean'):
+    """
+    Get average distance between reference and predicted for each cell type
+    """
+    losses = rowwise_distance(get_embeddings(results, 'pert_emb'), get_embeddings(results, 'pred_emb'), metric)
+    return _stratify(losses, _column(results, 'cell_type'))
+
+
+def get_stats(results, metric='euclidean'):
+    """
+    Print the full metric suite. PR is only available when the results carry a dose column.
+    """
+    print("Test PCP:", get_PCP(results, metric))
+    if _column(results, 'dose') is not None:
+        pr_results_perturbed, pr_results_predicted = get_PR(results, metric)
+        print("Test PR perturbed:", pr_results_perturbed)
+        print("Test PR predicted:", pr_results_predicted)
+    print("Test Loss:", get_validation_loss(results, metric))
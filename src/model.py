@@ -1,5 +1,8 @@
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from collections import OrderedDict
 
 
 class FiLM(nn.Module):
@@ -28,9 +31,11 @@ class FiLM(nn.Module):
         nn.init.uniform_(self.gamma[-1].weight, 0.9, 1.1)  # Start near identity
         # nn.init.normal_(self.beta[-1].weight, 0, 0.1)      # Small initial shifts
 
-    def forward(self, x, condition):
-        #condition = torch.cat([condition], dim=-1)
-        return self.gamma(condition) * x #+ self.beta(condition)
+    def forward(self, x, condition, gamma=None):
+        # gamma can be precomputed for all layers at once, see FiLMModel.compute_gammas
+        if gamma is None:
+            gamma = self.gamma(condition)
+        return gamma * x #+ self.beta(condition)
 
 
 class FiLMModel(nn.Module):
@@ -68,18 +73,121 @@ class FiLMModel(nn.Module):
             nn.Linear(512, input_dim)
         )
 
-    def forward(self, input, condition):
+    def compute_gammas(self, condition):
+        """
+        Gammas of all FiLM layers from one matmul per conditioning stage, shape (batch, num_layers, hidden_dim).
+        Uses the per-layer FiLM parameters as they are (stacked on the fly), so checkpoints are unchanged;
+        in eval mode the result equals calling every layer's gamma network on its own.
+        """
+        gammas = [film_block[0].gamma for film_block in self.film_layers]
+        linear_in, layer_norm, dropout = gammas[0][0], gammas[0][1], gammas[0][3]
+
+        # first linear of all layers as one (batch, num_layers * 512) matmul
+        weight_in = torch.cat([gamma[0].weight for gamma in gammas])
+        bias_in = torch.cat([gamma[0].bias for gamma in gammas])
+        h = F.linear(condition, weight_in, bias_in).view(len(condition), len(gammas), linear_in.out_features)
+
+        # per layer LayerNorm: shared normalization, stacked affine parameters
+        h = F.layer_norm(h, layer_norm.normalized_shape, eps=layer_norm.eps)
+        h = h * torch.stack([gamma[1].weight for gamma in gammas]) + torch.stack([gamma[1].bias for gamma in gammas])
+        h = F.dropout(F.gelu(h), dropout.p, self.training)
+
+        # second linear of all layers as one batched matmul over the layer axis
+        weight_out = torch.stack([gamma[4].weight for gamma in gammas])
+        bias_out = torch.stack([gamma[4].bias for gamma in gammas])
+        return torch.baddbmm(bias_out.unsqueeze(1), h.transpose(0, 1), weight_out.transpose(1, 2)).transpose(0, 1)
+
+    def forward(self, input, condition, gammas=None):
         # Progressive input projection
         x = self.input_proj(input)
 
-        for film_block in self.film_layers:
+        # the condition does not depend on x, so all layer gammas are computed up front
+        # (or gathered from a GammaCache at inference)
+        if gammas is None:
+            gammas = self.compute_gammas(condition)
+
+        for i, film_block in enumerate(self.film_layers):
             residual = x
             # Correct order: FiLM → Residual → LayerNorm → ReLU
-            x = film_block[0](x, condition) 
+            x = film_block[0](x, condition, gamma=gammas[:, i])
             x = x + residual
             x = film_block[1](x)  # LayerNorm after residual
             x = film_block[2](x)  # ReLU
         return self.output_proj(x)
 
         # Gradual output reconstruction
-        return self.output_proj(x)
\ No newline at end of file
+        return self.output_proj(x)
+
+
+class GammaCache():
+    """
+    Inference cache of the FiLM gammas (all layers) of every compound, keyed by compound id (the index into
+    one compound registry, e.g. the compound_idx meta of a dataset), with LRU eviction beyond max_size entries.
+    Batches only compute the gammas of compounds not cached yet and gather the rest by id.
+
+    The cache is cleared whenever the FiLM weights change: parameters are fingerprinted by their storage,
+    version counter and a checksum (fused optimizer steps do not bump the version counter).
+    In training mode (dropout active) nothing is cached.
+    """
+
+    def __init__(self, model, max_size=None):
+        self.model = model
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.fingerprint = None
+        self.checksum = None
+        self.hits = 0
+        self.misses = 0
+
+    def __parameters(self):
+        return [p for film_block in self.model.film_layers for p in film_block[0].parameters()]
+
+    def __validate(self):
+        parameters = self.__parameters()
+        fingerprint = tuple((p.data_ptr(), p._version) for p in parameters)
+        with torch.no_grad():
+            checksum = torch.stack([p.sum() for p in parameters])
+
+        if fingerprint != self.fingerprint or not torch.equal(checksum, self.checksum):
+            self.cache.clear()
+            self.fingerprint = fingerprint
+            self.checksum = checksum
+
+    def __len__(self):
+        return len(self.cache)
+
+    def clear(self):
+        self.cache.clear()
+        self.fingerprint = None
+
+    def gammas(self, compound_idx, condition):
+        """
+        Gammas (batch, num_layers, hidden_dim) of a batch, given the compound id and condition of every row
+        """
+        if self.model.training:
+            return self.model.compute_gammas(condition)
+        self.__validate()
+
+        compound_idx = np.asarray(compound_idx.cpu() if isinstance(compound_idx, torch.Tensor) else compound_idx)
+        ids, first, inverse = np.unique(compound_idx, return_index=True, return_inverse=True)
+
+        missing = [i for i, key in enumerate(ids.tolist()) if key not in self.cache]
+        self.hits += len(ids) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            rows = torch.as_tensor(first[missing], device=condition.device)
+            with torch.no_grad():
+                computed = self.model.compute_gammas(condition[rows])
+            for key, gamma in zip(ids[missing].tolist(), computed):
+                self.cache[key] = gamma
+
+        keys = ids.tolist()
+        for key in keys:
+            self.cache.move_to_end(key)
+        table = torch.stack([self.cache[key] for key in keys])
+
+        if self.max_size is not None:
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+        return table[torch.as_tensor(inverse.reshape(-1), device=table.device)]
\ No newline at end of file
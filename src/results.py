@@ -0,0 +1,287 @@
+import os
+import h5py
+import numpy as np
+import pandas as pd
+import torch
+
+from edistance import group_rows
+
+
+class TestResults():
+    """
+    Columnar store of test results: contiguous (N, dim) float32 matrices for the control, perturbed
+    and predicted embeddings plus categorical metadata columns. Batches are written straight into
+    preallocated buffers and every consumer works on (zero-copy) slices of the matrices.
+    """
+    EMBEDDINGS = ('ctrl_emb', 'pert_emb', 'pred_emb')
+    META = ('compound', 'cell_type')
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.n_written = 0
+        self.embeddings = dict()
+        self.meta = {name: np.empty(n_rows, dtype=object) for name in self.META}
+        self.__obs = None
+
+    @classmethod
+    def from_arrays(cls, ctrl_emb, pert_emb, pred_emb, compound, cell_type):
+        results = cls(len(ctrl_emb))
+        results.append(ctrl_emb, pert_emb, pred_emb, compound, cell_type)
+        return results
+
+    @classmethod
+    def from_columns(cls, embeddings, meta):
+        """
+        Wrap existing arrays (e.g. memory-mapped ones) without copying them
+        """
+        results = cls(0)
+        results.n_rows = results.n_written = len(next(iter(embeddings.values())))
+        results.embeddings = dict(embeddings)
+        results.meta = {name: np.asarray(meta[name], dtype=object) for name in cls.META}
+        return results
+
+    def append(self, ctrl_emb, pert_emb, pred_emb, compound, cell_type):
+        """
+        Write one batch into the next rows of the buffers. Embeddings may be tensors on any device.
+        """
+        start, stop = self.n_written, self.n_written + len(ctrl_emb)
+        if stop > self.n_rows:
+            raise ValueError(f"Results buffer holds {self.n_rows} rows, got {stop}")
+
+        for name, values in zip(self.EMBEDDINGS, (ctrl_emb, pert_emb, pred_emb)):
+            if isinstance(values, torch.Tensor):
+                values = values.detach().float().cpu().numpy()
+            if name not in self.embeddings:
+                # buffers are allocated on the first batch, once the embedding size is known
+                self.embeddings[name] = np.empty((self.n_rows, values.shape[1]), dtype=np.float32)
+            self.embeddings[name][start:stop] = values
+
+        self.meta['compound'][start:stop] = compound
+        self.meta['cell_type'][start:stop] = cell_type
+
+        self.n_written = stop
+        self.__obs = None
+
+    def __len__(self):
+        return self.n_written
+
+    @property
+    def obs(self):
+        """
+        Metadata as a DataFrame of categorical columns
+        """
+        if self.__obs is None:
+            self.__obs = pd.DataFrame({name: pd.Categorical(values[:self.n_written])
+                                       for name, values in self.meta.items()})
+        return self.__obs
+
+    def __getitem__(self, column):
+        if column in self.EMBEDDINGS:
+            return self.embeddings[column][:self.n_written]
+        return self.obs[column]
+
+    @property
+    def ctrl_emb(self):
+        return self['ctrl_emb']
+
+    @property
+    def pert_emb(self):
+        return self['pert_emb']
+
+    @property
+    def pred_emb(self):
+        return self['pred_emb']
+
+    def subset(self, rows):
+        """
+        Results restricted to the given rows (a boolean mask, index array or slice)
+        """
+        if isinstance(rows, pd.Series):
+            rows = rows.to_numpy()
+        obs = self.obs.iloc[rows]
+        return TestResults.from_arrays(self.ctrl_emb[rows], self.pert_emb[rows], self.pred_emb[rows],
+                                       obs['compound'].to_numpy(), obs['cell_type'].to_numpy())
+
+    def to_frame(self):
+        """
+        The results in the old DataFrame layout, with one array per row in the embedding columns
+        """
+        frame = {name: list(self[name]) for name in self.EMBEDDINGS}
+        frame.update({name: self.meta[name][:self.n_written] for name in self.META})
+        return pd.DataFrame(frame)
+
+    def save(self, path, dtype=np.float32, compression=None):
+        """
+        Save the results in a binary format chosen by extension:
+            .npz:       one array per column, compressed (zip) if compression is set
+            .h5/.hdf5:  one dataset per column; contiguous when uncompressed (so load_results can mmap it),
+                        otherwise chunked with the given h5py compression ('gzip', 'lzf', ...)
+        Embeddings are stored as dtype (e.g. np.float16 to halve the size), metadata as categorical codes.
+        """
+        columns = {name: self[name].astype(dtype, copy=False) for name in self.EMBEDDINGS}
+        for name in self.META:
+            categorical = self.obs[name]
+            columns[name + "_codes"] = categorical.cat.codes.to_numpy().astype(np.int32)
+            columns[name + "_categories"] = categorical.cat.categories.to_numpy().astype(str)
+
+        extension = os.path.splitext(path)[1]
+        if extension == '.npz':
+            if compression:
+                np.savez_compressed(path, **columns)
+            else:
+                np.savez(path, **columns)
+        elif extension in ('.h5', '.hdf5'):
+            with h5py.File(path, 'w') as f:
+                for name, values in columns.items():
+                    if values.dtype.kind == 'U':
+                        f.create_dataset(name, data=values.astype(object), dtype=h5py.string_dtype())
+                    elif compression and values.ndim == 2:
+                        chunk_rows = max(1, min(len(values), (1 << 20) // max(1, values.shape[1] * values.itemsize)))
+                        f.create_dataset(name, data=values, chunks=(chunk_rows, values.shape[1]),
+                                         compression=compression)
+                    else:
+                        f.create_dataset(name, data=values)
+        else:
+            raise ValueError(f"Unsupported binary format: {extension}")
+
+    def __repr__(self):
+        dims = {name: values.shape[1] for name, values in self.embeddings.items()}
+        return f"TestResults(n_rows={len(self)}, embeddings={dims}, meta={list(self.META)})"
+
+
+class StreamingResultsWriter():
+    """
+    Append-only HDF5 store for large test/inference runs: every batch is written to resizable chunked
+    datasets as it arrives, and per (cell type, compound) sums are kept online so E-distance statistics
+    are available without holding the embeddings. Memory is bounded by one batch.
+    The file has the TestResults.save layout and can be read back with load_results.
+    """
+
+    def __init__(self, path, dtype=np.float32, compression=None, chunk_rows=1024):
+        self.path = path
+        self.dtype = dtype
+        self.compression = compression
+        self.chunk_rows = chunk_rows
+        self.n_written = 0
+
+        self.file = h5py.File(path, 'w')
+        self.categories = {name: dict() for name in TestResults.META}
+        self.group_sums = dict()
+        self.group_counts = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __extend(self, name, values):
+        if name not in self.file:
+            self.file.create_dataset(name, shape=(0,) + values.shape[1:], maxshape=(None,) + values.shape[1:],
+                                     dtype=values.dtype, chunks=(self.chunk_rows,) + values.shape[1:],
+                                     compression=self.compression)
+        dataset = self.file[name]
+        dataset.resize(self.n_written + len(values), axis=0)
+        dataset[self.n_written:] = values
+
+    def __encode(self, name, values):
+        categories = self.categories[name]
+        return np.array([-1 if v is None else categories.setdefault(v, len(categories)) for v in values],
+                        dtype=np.int32)
+
+    def append(self, ctrl_emb, pert_emb, pred_emb, compound, cell_type):
+        embeddings = list()
+        for name, values in zip(TestResults.EMBEDDINGS, (ctrl_emb, pert_emb, pred_emb)):
+            if isinstance(values, torch.Tensor):
+                values = values.detach().float().cpu().numpy()
+            embeddings.append(values)
+            self.__extend(name, values.astype(self.dtype, copy=False))
+
+        self.__extend("compound_codes", self.__encode('compound', compound))
+        self.__extend("cell_type_codes", self.__encode('cell_type', cell_type))
+
+        # online per-group sums for the E-distance statistics
+        order, offsets, keys = group_rows(cell_type, compound)
+        if len(keys) == 0:
+            self.n_written += len(embeddings[0])
+            return
+
+        sums = [np.add.reduceat(values[order], offsets[:-1], axis=0, dtype=np.float64) for values in embeddings]
+        for i, key in enumerate(keys):
+            if key not in self.group_sums:
+                self.group_sums[key] = np.zeros((3, sums[0].shape[1]))
+                self.group_counts[key] = 0
+            self.group_sums[key] += np.stack([group_sum[i] for group_sum in sums])
+            self.group_counts[key] += offsets[i + 1] - offsets[i]
+
+        self.n_written += len(embeddings[0])
+
+    def __len__(self):
+        return self.n_written
+
+    def model_stats(self):
+        """
+        Same statistics as utils.get_model_stats, from the online group sums
+        """
+        results_pred_loss = dict()
+        results_null_loss = dict()
+        results_similarity_loss = dict()
+
+        for (cell_type, compound), sums in self.group_sums.items():
+            ctrl_mean, pert_mean, pred_mean = sums / self.group_counts[(cell_type, compound)]
+
+            key = cell_type + "_" + compound
+            results_pred_loss[key] = 2 * float(((pert_mean - pred_mean) ** 2).sum())
+            results_null_loss[key] = 2 * float(((ctrl_mean - pert_mean) ** 2).sum())
+            results_similarity_loss[key] = 2 * float(((ctrl_mean - pred_mean) ** 2).sum())
+
+        return results_pred_loss, results_null_loss, results_similarity_loss
+
+    def close(self):
+        if self.file is None:
+            return
+        for name, categories in self.categories.items():
+            self.file.create_dataset(name + "_categories", data=np.array(list(categories), dtype=object),
+                                     dtype=h5py.string_dtype())
+        self.file.close()
+        self.file = None
+
+
+def _decode_meta(codes, categories):
+    values = np.empty(len(codes), dtype=object)
+    values[codes >= 0] = np.asarray(categories, dtype=object)[codes[codes >= 0]]
+    return values
+
+
+def load_results(path, mmap=True):
+    """
+    Load results written by TestResults.save. Uncompressed HDF5 embeddings are memory-mapped
+    (when mmap is set) instead of read, everything else is read as binary arrays without parsing.
+    """
+    extension = os.path.splitext(path)[1]
+    embeddings = dict()
+    meta = dict()
+
+    if extension == '.npz':
+        with np.load(path) as columns:
+            for name in TestResults.EMBEDDINGS:
+                embeddings[name] = columns[name]
+            for name in TestResults.META:
+                meta[name] = _decode_meta(columns[name + "_codes"], columns[name + "_categories"])
+    elif extension in ('.h5', '.hdf5'):
+        with h5py.File(path, 'r') as f:
+            for name in TestResults.EMBEDDINGS:
+                dataset = f[name]
+                offset = dataset.id.get_offset()
+                if mmap and dataset.chunks is None and offset is not None:
+                    embeddings[name] = np.memmap(path, mode='r', dtype=dataset.dtype, offset=offset,
+                                                 shape=dataset.shape)
+                else:
+                    embeddings[name] = dataset[:]
+            for name in TestResults.META:
+                categories = f[name + "_categories"].asstr()[:]
+                meta[name] = _decode_meta(f[name + "_codes"][:], categories)
+    else:
+        raise ValueError(f"Unsupported binary format: {extension}")
+
+    return TestResults.from_columns(embeddings, meta)
@@ -0,0 +1,394 @@
+import os
+import csv
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+from sklearn.linear_model import LogisticRegression
+from tqdm import tqdm
+
+from edistance import group_rows
+from vehicle_scan import read_rows
+
+
+FIELDS = ['compound', 'dose', 'cell_type', 'precision', 'recall', 'f1-score', 'support',
+          'sample_size_treated', 'sample_size_control', 'sample_size_total']
+
+# per worker process: the attached vehicle splits, the training buffers and the warm start models
+_vehicle_train = None
+_vehicle_test = None
+_initial_models = None
+_buffers = dict()
+_handles = list()
+
+
+def split_rows(n, test_size, rng):
+    """
+    Shuffle range(n) and hold out int(n * test_size) rows for testing.
+    Returns (train_rows, test_rows).
+    """
+    indices = rng.permutation(n)
+    n_test = int(n * test_size)
+    return indices[n_test:], indices[:n_test]
+
+
+class SharedArray():
+    """
+    A numpy array in a named shared memory block. Pickles as its name, shape and dtype, so worker
+    processes attach to the same memory instead of receiving a copy.
+    """
+
+    def __init__(self, array=None, name=None, shape=None, dtype=None):
+        if array is not None:
+            self.shape, self.dtype = array.shape, np.dtype(array.dtype)
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            self.name = self.shm.name
+            self.array[...] = array
+        else:
+            self.shape, self.dtype, self.name = shape, np.dtype(dtype), name
+            self.shm = shared_memory.SharedMemory(name=name)
+
+    @property
+    def array(self):
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __reduce__(self):
+        return SharedArray, (None, self.name, self.shape, self.dtype)
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _init_worker(vehicle_train, vehicle_test, initial_models):
+    global _vehicle_train, _vehicle_test, _initial_models
+    _initial_models = initial_models
+    # keep the handles alive for the lifetime of the worker
+    _handles.extend(list(vehicle_train.values()) + list(vehicle_test.values()))
+    _vehicle_train = {cell_type: shared.array for cell_type, shared in vehicle_train.items()}
+    _vehicle_test = {cell_type: shared.array for cell_type, shared in vehicle_test.items()}
+
+
+def _training_rows(cell_type, X_treated):
+    """
+    Training matrix [treated rows; vehicle training rows] as a contiguous view of a per-cell-type buffer
+    whose tail holds the vehicle rows, copied once per worker; only the treated rows are written per fit.
+    """
+    V = _vehicle_train[cell_type]
+    buffer = _buffers.get(cell_type)
+    if buffer is None or len(buffer) - len(V) < len(X_treated):
+        head = max(len(X_treated), 2 * (len(buffer) - len(V)) if buffer is not None else 0)
+        buffer = np.empty((head + len(V), V.shape[1]), dtype=V.dtype)
+        buffer[head:] = V
+        _buffers[cell_type] = buffer
+
+    start = len(buffer) - len(V) - len(X_treated)
+    buffer[start:start + len(X_treated)] = X_treated
+    return buffer[start:]
+
+
+def _fit_group(task):
+    """
+    Fit and score one treated-vs-vehicle classifier in a worker process
+    """
+    key, X_treated, test_size, seed, warm_start, max_iter = task
+    compound, cell_type, dose = key
+
+    # every group has its own generator, so the split does not depend on scheduling
+    train_rows, test_rows = split_rows(len(X_treated), test_size, np.random.default_rng(seed))
+    V_train, V_test = _vehicle_train[cell_type], _vehicle_test[cell_type]
+
+    X_train = _training_rows(cell_type, X_treated[train_rows])
+    y_train = np.concatenate([np.ones(len(train_rows)), np.zeros(len(V_train))])
+
+    # warm start from the fixed model of the cell type, fitted once before the pool started,
+    # so the starting point does not depend on which groups a worker fitted before
+    model = LogisticRegression(class_weight='balanced', warm_start=warm_start, max_iter=max_iter)
+    if warm_start:
+        coef, intercept = _initial_models[cell_type]
+        model.coef_, model.intercept_ = coef.copy(), intercept.copy()
+    model.fit(X_train, y_train)
+
+    # class 1 metrics from the confusion counts
+    true_positives = int(model.predict(X_treated[test_rows]).sum())
+    false_positives = int(model.predict(V_test).sum())
+    support = len(test_rows)
+    precision = true_positives / (true_positives + false_positives) if true_positives + false_positives else 0.0
+    recall = true_positives / support if support else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+    n_control = len(V_train) + len(V_test)
+    return {'compound': compound, 'dose': dose, 'cell_type': cell_type,
+            'precision': precision, 'recall': recall, 'f1-score': f1, 'support': support,
+            'sample_size_treated': len(X_treated), 'sample_size_control': n_control,
+            'sample_size_total': len(X_treated) + n_control}
+
+
+def _vehicle_splits(adata, vehicle, test_size, seed, n_groups):
+    """
+    One train/test split of the vehicle pool of every cell type (shared by all of its groups) and one
+    seed per group for the treated split, all derived from seed.
+    Returns ({cell_type: (V_train, V_test)}, group_seeds).
+    """
+    compounds = adata.obs['product_name'].to_numpy()
+    cell_types = adata.obs['cell_type'].to_numpy()
+
+    vehicle_seed, group_seed = np.random.SeedSequence(seed).spawn(2)
+    rng = np.random.default_rng(vehicle_seed)
+
+    splits = dict()
+    for cell_type in pd.unique(cell_types):
+        rows = np.flatnonzero((compounds == vehicle) & (cell_types == cell_type))
+        if len(rows) == 0:
+            raise ValueError(f"No vehicle controls for cell type: {cell_type}")
+        V = read_rows(adata.X, rows).astype(np.float32)
+        train_rows, test_rows = split_rows(len(V), test_size, rng)
+        splits[cell_type] = (V[train_rows], V[test_rows])
+
+    return splits, group_seed.generate_state(n_groups)
+
+
+def _initial_models(adata, vehicle_splits, vehicle, seed, max_iter):
+    """
+    Warm start model (coef, intercept) of every cell type: treated (pooled over all compounds and doses,
+    subsampled to the size of the vehicle training split) vs vehicle training cells
+    """
+    compounds = adata.obs['product_name'].to_numpy()
+    cell_types = adata.obs['cell_type'].to_numpy()
+    rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(3)[2])
+
+    models = dict()
+    for cell_type, (V_train, _) in vehicle_splits.items():
+        treated = np.flatnonzero((compounds != vehicle) & (cell_types == cell_type) & (adata.obs['dose'].to_numpy() != 0.0))
+        if len(treated) == 0:
+            continue
+        treated = rng.choice(treated, min(len(treated), len(V_train)), replace=False)
+        X = np.concatenate([read_rows(adata.X, treated).astype(np.float32), V_train])
+        y = np.concatenate([np.ones(len(treated)), np.zeros(len(V_train))])
+        model = LogisticRegression(class_weight='balanced', max_iter=max_iter).fit(X, y)
+        models[cell_type] = (model.coef_, model.intercept_)
+    return models
+
+
+def _completed_groups(savefile):
+    if savefile is None or not os.path.exists(savefile) or os.path.getsize(savefile) == 0:
+        return set()
+    done = pd.read_csv(savefile, usecols=['compound', 'dose', 'cell_type'])
+    return set(zip(done['compound'].astype(str), done['dose'].astype(float), done['cell_type'].astype(str)))
+
+
+def calculate_separability(adata, savefile=None, vehicle='Vehicle', test_size=0.2, seed=None, n_workers=None,
+                           warm_start=False, max_iter=100):
+    """
+    Treated-vs-vehicle logistic regression (balanced class weights) for every compound x cell type x dose
+    group, scored with precision/recall/f1 of the treated class on a held-out test split.
+
+    The vehicle pool of every cell type is split once and placed in shared memory; groups are fitted
+    in parallel over a process pool of n_workers. Rows are appended to savefile as groups complete and
+    groups already present in savefile are skipped, so an interrupted scan resumes where it stopped.
+    With warm_start, every fit starts from one pooled treated-vs-vehicle model per cell type, fitted
+    once up front. All randomness comes from seed, the global numpy RNG is left alone, and results do
+    not depend on n_workers or scheduling.
+
+    Returns the results as a DataFrame (including resumed rows when savefile is given).
+    """
+    obs = adata.obs
+    compounds = obs['product_name'].to_numpy()
+    cell_types = obs['cell_type'].to_numpy()
+    doses = obs['dose'].to_numpy()
+
+    order, offsets, keys = group_rows(compounds, cell_types, doses)
+    done = _completed_groups(savefile)
+    groups = [(i, key) for i, key in enumerate(keys)
+              if key[0] != vehicle and key[2] != 0.0 and (str(key[0]), float(key[2]), str(key[1])) not in done]
+
+    vehicle_splits, group_seeds = _vehicle_splits(adata, vehicle, test_size, seed, len(keys))
+    initial_models = _initial_models(adata, vehicle_splits, vehicle, seed, max_iter) if warm_start else None
+    vehicle_train = {cell_type: SharedArray(train) for cell_type, (train, _) in vehicle_splits.items()}
+    vehicle_test = {cell_type: SharedArray(test) for cell_type, (_, test) in vehicle_splits.items()}
+    del vehicle_splits
+
+    writer = None
+    if savefile is not None:
+        new_file = not os.path.exists(savefile) or os.path.getsize(savefile) == 0
+        f = open(savefile, 'a', newline='')
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        if new_file:
+            writer.writeheader()
+
+    def collect(futures):
+        for future in futures:
+            row = future.result()
+            results.append(row)
+            if writer is not None:
+                writer.writerow(row)
+                f.flush()
+        progress.update(len(futures))
+
+    results = list()
+    n_workers = n_workers or os.cpu_count()
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(vehicle_train, vehicle_test, initial_models)) as executor, \
+                tqdm(total=len(groups)) as progress:
+            pending = set()
+            for i, key in groups:
+                if len(pending) >= 2 * n_workers:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                X_treated = read_rows(adata.X, order[offsets[i]:offsets[i + 1]]).astype(np.float32)
+                task = (key, X_treated, test_size, group_seeds[i], warm_start, max_iter)
+                pending.add(executor.submit(_fit_group, task))
+
+            finished, _ = wait(pending)
+            collect(finished)
+    finally:
+        if writer is not None:
+            f.close()
+        for shared in list(vehicle_train.values()) + list(vehicle_test.values()):
+            shared.close(unlink=True)
+
+    if savefile is not None:
+        return pd.read_csv(savefile)
+    return pd.DataFrame(results, columns=FIELDS)
+
+
+def _pad_groups(X_groups):
+    """
+    Rows of every group stacked into zero-padded (n_groups, width, n_vars) float32 blocks, one block
+    per power-of-two width, so padding stays below 2x the data.
+    Returns a list of (group indices, X, mask) tensors, mask marking the real rows.
+    """
+    sizes = np.array([len(X) for X in X_groups])
+    widths = 2 ** np.ceil(np.log2(np.maximum(sizes, 1))).astype(np.int64)
+    n_vars = X_groups[0].shape[1]
+
+    blocks = list()
+    for width in np.unique(widths):
+        group_idx = np.flatnonzero(widths == width)
+        X = np.zeros((len(group_idx), width, n_vars), dtype=np.float32)
+        mask = np.zeros((len(group_idx), width), dtype=bool)
+        for j, g in enumerate(group_idx):
+            X[j, :sizes[g]] = X_groups[g]
+            mask[j, :sizes[g]] = True
+        blocks.append((torch.from_numpy(group_idx), torch.from_numpy(X), torch.from_numpy(mask)))
+    return blocks
+
+
+def _block_logits(X, W, b):
+    """
+    Logits of a padded block against the weights of its groups, one batched matmul: (n_groups, width)
+    """
+    return torch.baddbmm(b.float()[:, None, None], X, W.float()[:, :, None]).squeeze(-1).double()
+
+
+def calculate_separability_batched(adata, savefile=None, vehicle='Vehicle', test_size=0.2, seed=None, C=1.0,
+                                   max_iter=1000, tolerance=1e-9):
+    """
+    Batched linear-probe mode of calculate_separability: the logistic regressions of all groups are
+    trained at once as one torch model on the CPU (one weight vector and bias per group).
+
+    The objective per group is the sklearn one (balanced class weights, L2 penalty 1 / (2C) on the
+    weights), scaled by the number of training rows so groups are comparable, and all of them are
+    minimised jointly with L-BFGS. Data stays in float32: vehicle logits of a cell type come from one
+    matmul against the weights of all of its groups, treated logits from batched matmuls over the
+    groups' rows padded per power-of-two size (see _pad_groups); losses are summed in float64.
+    Splits are the ones calculate_separability draws for the same seed, so both modes score the same
+    test rows.
+
+    Returns the results as a DataFrame; with savefile the rows are appended to it (completed groups
+    are skipped).
+    """
+    obs = adata.obs
+    order, offsets, keys = group_rows(obs['product_name'].to_numpy(), obs['cell_type'].to_numpy(),
+                                      obs['dose'].to_numpy())
+    done = _completed_groups(savefile)
+    groups = [(i, key) for i, key in enumerate(keys)
+              if key[0] != vehicle and key[2] != 0.0 and (str(key[0]), float(key[2]), str(key[1])) not in done]
+    if len(groups) == 0:
+        return pd.read_csv(savefile) if savefile is not None else pd.DataFrame(columns=FIELDS)
+
+    vehicle_splits, group_seeds = _vehicle_splits(adata, vehicle, test_size, seed, len(keys))
+    cell_type_names = list(vehicle_splits)
+    V_train = [torch.from_numpy(vehicle_splits[name][0]) for name in cell_type_names]
+    V_test = [torch.from_numpy(vehicle_splits[name][1]) for name in cell_type_names]
+    n_vehicle = np.array([len(vehicle_splits[name][0]) for name in cell_type_names])
+
+    # train and test rows of every group, read one group at a time
+    train_X, test_X = list(), list()
+    n_treated = np.zeros(len(groups), dtype=np.int64)
+    for g, (i, key) in enumerate(groups):
+        X_treated = read_rows(adata.X, order[offsets[i]:offsets[i + 1]]).astype(np.float32)
+        train_rows, test_rows = split_rows(len(X_treated), test_size, np.random.default_rng(group_seeds[i]))
+        train_X.append(X_treated[train_rows])
+        test_X.append(X_treated[test_rows])
+        n_treated[g] = len(X_treated)
+    n_train = np.array([len(X) for X in train_X])
+    n_test = np.array([len(X) for X in test_X])
+    n_vars = train_X[0].shape[1]
+    train_blocks = _pad_groups(train_X)
+    test_blocks = _pad_groups(test_X)
+    del train_X, test_X
+
+    # groups of every cell type, for the per cell type vehicle matmuls
+    codes = np.array([cell_type_names.index(key[1]) for _, key in groups])
+    members = [torch.from_numpy(np.flatnonzero(codes == c)) for c in range(len(cell_type_names))]
+
+    n_positive = torch.from_numpy(n_train).double()
+    n_negative = torch.from_numpy(n_vehicle[codes]).double()
+    n_total = n_positive + n_negative
+    # balanced class weights n / (2 * n_class), with the 1 / n scaling of every group objective folded in
+    weight_positive = 1 / (2 * n_positive)
+    weight_negative = 1 / (2 * n_negative)
+
+    W = torch.zeros(len(groups), n_vars, dtype=torch.float64, requires_grad=True)
+    b = torch.zeros(len(groups), dtype=torch.float64, requires_grad=True)
+    optimizer = torch.optim.LBFGS([W, b], lr=1, max_iter=max_iter, tolerance_grad=tolerance,
+                                  tolerance_change=1e-12, history_size=20, line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        loss = ((W ** 2).sum(dim=1) / (2 * C * n_total)).sum()
+        for group_idx, X, mask in train_blocks:
+            treated_logits = _block_logits(X, W[group_idx], b[group_idx])
+            loss = loss + (weight_positive[group_idx] * (F.softplus(-treated_logits) * mask).sum(dim=1)).sum()
+        for c, group_idx in enumerate(members):
+            if len(group_idx) == 0:
+                continue
+            vehicle_logits = (V_train[c] @ W[group_idx].float().T + b[group_idx].float()).double()
+            loss = loss + (weight_negative[group_idx] * F.softplus(vehicle_logits).sum(dim=0)).sum()
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+
+    # class 1 confusion counts of every group on the held-out rows
+    with torch.no_grad():
+        true_positives = np.zeros(len(groups), dtype=np.int64)
+        for group_idx, X, mask in test_blocks:
+            true_positives[group_idx.numpy()] = ((_block_logits(X, W[group_idx], b[group_idx]) > 0) & mask).sum(dim=1).numpy()
+        false_positives = np.zeros(len(groups), dtype=np.int64)
+        for c, group_idx in enumerate(members):
+            if len(group_idx) > 0:
+                vehicle_logits = V_test[c] @ W[group_idx].float().T + b[group_idx].float()
+                false_positives[group_idx.numpy()] = (vehicle_logits > 0).sum(dim=0).numpy()
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = np.nan_to_num(true_positives / (true_positives + false_positives))
+        recall = np.nan_to_num(true_positives / n_test)
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+
+    n_control = np.array([len(vehicle_splits[name][0]) + len(vehicle_splits[name][1]) for name in cell_type_names])[codes]
+    results = pd.DataFrame({'compound': [key[0] for _, key in groups], 'dose': [key[2] for _, key in groups],
+                            'cell_type': [key[1] for _, key in groups], 'precision': precision, 'recall': recall,
+                            'f1-score': f1, 'support': n_test, 'sample_size_treated': n_treated,
+                            'sample_size_control': n_control, 'sample_size_total': n_treated + n_control})
+
+    if savefile is not None:
+        new_file = not os.path.exists(savefile) or os.path.getsize(savefile) == 0
+        results.to_csv(savefile, mode='a', header=new_file, index=False)
+        return pd.read_csv(savefile)
+    return results
@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+
+
+class TensorStore():
+    """
+    In-memory training store: the embedding rows, drug table and pair index of a Sciplex dataset
+    are materialized once on the training device, so every step is a randperm slice and a gather
+    without collate work or host-to-device copies.
+    """
+
+    def __init__(self, dataset, device, indices=None):
+        self.device = device
+        self.control_sampling = dataset.control_sampling
+
+        if indices is None:
+            indices = np.arange(len(dataset))
+        treated_idx = np.asarray(dataset.treated_idx[indices])
+        control_idx = np.asarray(dataset.control_idx[indices])
+        compound_idx = np.asarray(dataset.compound_idx[indices])
+
+        # only the rows the pairs (and their control pools) can touch are copied
+        touched = [treated_idx, control_idx]
+        if self.control_sampling != 'fixed':
+            touched.append(dataset.control_pool_rows)
+        rows, remap = np.unique(np.concatenate(touched), return_inverse=True)
+        n = len(treated_idx)
+
+        self.X = torch.from_numpy(dataset.source.take(rows)).to(device)
+        self.drug_embeddings = torch.from_numpy(dataset.compound_embeddings.embeddings).to(device)
+        self.treated_idx = torch.from_numpy(remap[:n]).to(device)
+        self.control_idx = torch.from_numpy(remap[n:2 * n]).to(device)
+        # -1 ("no compound") points at the trailing zero row of the drug table
+        self.compound_idx = torch.from_numpy(compound_idx % len(self.drug_embeddings)).long().to(device)
+
+        if self.control_sampling != 'fixed':
+            self.control_pool_rows = torch.from_numpy(remap[2 * n:]).to(device)
+            self.control_pool_sizes = torch.from_numpy(dataset.control_pool_sizes).to(device)
+            self.control_pool_offsets = torch.from_numpy(dataset.control_pool_offsets).to(device)
+            self.pool_codes = torch.from_numpy(dataset.cell_type_codes[treated_idx]).long().to(device)
+            self.negative = torch.from_numpy(compound_idx == -1).to(device)
+
+    def __len__(self):
+        return len(self.treated_idx)
+
+    def __draw_controls(self, idx):
+        codes = self.pool_codes[idx]
+        sizes = self.control_pool_sizes[codes]
+        offsets = self.control_pool_offsets[codes]
+        draw = (torch.rand(len(idx), device=self.device) * sizes).long()
+        control_idx = self.control_pool_rows[offsets + draw]
+
+        # negative pairs stay mapped onto themselves
+        return torch.where(self.negative[idx], self.treated_idx[idx], control_idx)
+
+    def resample_controls(self):
+        """
+        Redraw the control of every pair on the device, e.g. once per epoch
+        """
+        if self.control_sampling == 'fixed':
+            return
+        self.control_idx = self.__draw_controls(torch.arange(len(self), device=self.device))
+
+    def batches(self, batch_size, shuffle=True):
+        """
+        Yield (control_emb, drug_emb, treated_emb, idx) batches, where idx are the pair indices
+        """
+        n = len(self)
+        if shuffle:
+            order = torch.randperm(n, device=self.device)
+        else:
+            order = torch.arange(n, device=self.device)
+
+        for start in range(0, n, batch_size):
+            idx = order[start:start + batch_size]
+
+            if self.control_sampling == 'batch':
+                control_idx = self.__draw_controls(idx)
+            else:
+                control_idx = self.control_idx[idx]
+
+            yield (self.X[control_idx],
+                   self.drug_embeddings[self.compound_idx[idx]],
+                   self.X[self.treated_idx[idx]],
+                   idx)
+
+    def stacked(self, idx=None):
+        """
+        (control_emb, drug_emb, treated_emb) of the given pairs (all by default) with their current
+        control pairing, stacked once, e.g. as a validation cache
+        """
+        if idx is None:
+            idx = torch.arange(len(self), device=self.device)
+        return (self.X[self.control_idx[idx]],
+                self.drug_embeddings[self.compound_idx[idx]],
+                self.X[self.treated_idx[idx]])
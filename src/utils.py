@@ -3,7 +3,6 @@ import pandas as pd
 import seaborn as sns
 import itertools
 
-from sklearn.metrics import pairwise_distances
 from scipy.stats import spearmanr
 from tqdm import tqdm
 import seaborn as sns
@@ -12,14 +11,18 @@ import matplotlib.pyplot as plt
 from scipy.cluster.hierarchy import linkage, dendrogram
 from sklearn.preprocessing import StandardScaler
 
-def calculate_edistance(X, Y):
+from edistance import calculate_edistance, calculate_edistances, group_rows, segment_means
+
+
+def get_embeddings(test_results, column, rows=slice(None)):
     """
-    Calculate edistances between two matrices
+    Dense embedding matrix of a results column, from a TestResults container
+    or a DataFrame with one array per row
     """
-    sigma_X = pairwise_distances(X, X, metric="sqeuclidean").mean()
-    sigma_Y = pairwise_distances(Y, Y, metric="sqeuclidean").mean()
-    delta = pairwise_distances(X, Y, metric="sqeuclidean").mean()
-    return 2 * delta - sigma_X - sigma_Y
+    values = test_results[column]
+    if isinstance(values, pd.Series):
+        return np.stack(values.to_numpy()[rows])
+    return values[rows]
 
 
 def format_test_results(test_results_raw):
@@ -35,34 +38,29 @@ def format_test_results(test_results_raw):
 
 def get_model_stats(formatted_test_results):
     """
-    Calculate test results statistics
+    Calculate test results statistics.
+    Rows are grouped by cell type and compound in one sort, each group is a contiguous slice
+    and its E-distances follow from the group means.
     """
+    order, offsets, keys = group_rows(formatted_test_results['cell_type'], formatted_test_results['compound'])
+
+    ctrl_means = segment_means(get_embeddings(formatted_test_results, 'ctrl_emb', order), offsets)
+    pert_means = segment_means(get_embeddings(formatted_test_results, 'pert_emb', order), offsets)
+    pred_means = segment_means(get_embeddings(formatted_test_results, 'pred_emb', order), offsets)
+
+    edist_ctrl_pert = 2 * ((ctrl_means - pert_means) ** 2).sum(axis=1)
+    edist_ctrl_pred = 2 * ((ctrl_means - pred_means) ** 2).sum(axis=1)
+    edist_pert_pred = 2 * ((pert_means - pred_means) ** 2).sum(axis=1)
 
     results_pred_loss = dict()
     results_null_loss = dict()
     results_similarity_loss = dict()
 
-    for cell_type in formatted_test_results['cell_type'].unique():
-        losses = list()
-
-        df_subset = formatted_test_results[formatted_test_results['cell_type'] == cell_type]
-
-        for compound in tqdm(list(formatted_test_results['compound'].unique())):
-            df_subset = formatted_test_results[(formatted_test_results['cell_type'] == cell_type) &
-                                               (formatted_test_results['compound'] == compound)]
-
-            ctrl_X = np.array(df_subset['ctrl_emb'].tolist())
-            pert_X = np.array(df_subset['pert_emb'].tolist())
-            pred_X = np.array(df_subset['pred_emb'].tolist())
-
-            edist_ctrl_pert = calculate_edistance(ctrl_X, pert_X)
-            edist_ctrl_pred = calculate_edistance(ctrl_X, pred_X)
-            edist_pert_pred = calculate_edistance(pert_X, pred_X)
-
-            key = cell_type + "_" + compound
-            results_pred_loss[key] = edist_pert_pred
-            results_null_loss[key] = edist_ctrl_pert
-            results_similarity_loss[key] = edist_ctrl_pred
+    for i, (cell_type, compound) in enumerate(keys):
+        key = cell_type + "_" + compound
+        results_pred_loss[key] = edist_pert_pred[i]
+        results_null_loss[key] = edist_ctrl_pert[i]
+        results_similarity_loss[key] = edist_ctrl_pred[i]
 
     return results_pred_loss, results_null_loss, results_similarity_loss
 
@@ -110,29 +108,26 @@ def plot_compound_clustering(df, compound, cell_type, metric='euclidean', method
     for a specific compound and cell type.
     
     Parameters:
-    df (pd.DataFrame): Input dataframe with embeddings
+    df (pd.DataFrame or TestResults): Input results with embeddings
     compound (str): Name of compound to filter
     cell_type (str): Name of cell type to filter
     metric (str): Distance metric for clustering
     method (str): Linkage method for clustering
     """
-    # Filter dataframe
-    filtered = df[(df['compound'] == compound) & (df['cell_type'] == cell_type)]
+    # Filter rows
+    rows = np.flatnonzero((np.asarray(df['compound']) == compound) & (np.asarray(df['cell_type']) == cell_type))
     
-    if len(filtered) == 0:
+    if len(rows) == 0:
         print(f"No entries found for compound '{compound}' and cell type '{cell_type}'")
         return
     
-    # Prepare data matrix and labels
-    embeddings = []
-    labels = []
-    
-    for _, row in filtered.iterrows():
-        embeddings.extend([row['ctrl_emb'], row['pred_emb'], row['pert_emb']])
-        labels.extend(['Control', 'Predicted', 'Perturbed'])
+    # Interleave control, predicted and perturbed embeddings of each row
+    X = np.stack([get_embeddings(df, 'ctrl_emb', rows),
+                  get_embeddings(df, 'pred_emb', rows),
+                  get_embeddings(df, 'pert_emb', rows)], axis=1).reshape(3 * len(rows), -1)
+    labels = ['Control', 'Predicted', 'Perturbed'] * len(rows)
     
-    # Convert to numpy array and standardize
-    X = np.array(embeddings)
+    # Standardize
     X = StandardScaler().fit_transform(X)  # Standardize features
     
     # Create DataFrame for plotting
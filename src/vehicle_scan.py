@@ -0,0 +1,147 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from sklearn.metrics import pairwise_distances
+from tqdm import tqdm
+
+from edistance import group_rows
+
+
+# vehicle pools and their statistics, set once per worker process by _init_worker
+_vehicle_pools = None
+_vehicle_stats = None
+
+
+def _dense(X):
+    if sp.issparse(X):
+        return X.toarray()
+    return np.asarray(X)
+
+
+def read_rows(X, rows):
+    """
+    Rows of a (possibly backed or sparse) matrix as a dense float64 array, read in sorted order
+    """
+    return _dense(X[np.sort(rows)]).astype(np.float64, copy=False)
+
+
+def _pairwise_mean(A, B, metric, chunk_size):
+    """
+    Mean of the full pairwise distance matrix between A and B, built chunk_size rows at a time
+    """
+    total = 0.0
+    for start in range(0, len(A), chunk_size):
+        total += pairwise_distances(A[start:start + chunk_size], B, metric=metric).sum()
+    return total / (len(A) * len(B))
+
+
+def vehicle_statistics(V, metric='sqeuclidean', chunk_size=4096):
+    """
+    Statistics of a vehicle pool that every distance to it reuses: the row count, the mean and
+    the within-pool term mean d(V, V) (the quadratic part, computed once per pool)
+    """
+    V = np.asarray(V, dtype=np.float64)
+    mean = V.mean(axis=0)
+    if metric == 'sqeuclidean':
+        # mean squared distance between all pairs = 2 * (mean squared norm - squared norm of the mean)
+        self_term = 2 * float((V ** 2).sum(axis=1).mean() - mean @ mean)
+    else:
+        self_term = _pairwise_mean(V, V, metric, chunk_size)
+    return {"n": len(V), "mean": mean, "self_term": self_term}
+
+
+def _init_worker(vehicle_pools, vehicle_stats):
+    global _vehicle_pools, _vehicle_stats
+    _vehicle_pools = vehicle_pools
+    _vehicle_stats = vehicle_stats
+
+
+def _scan_group(task):
+    """
+    E-distance between one group and the vehicle pool of its cell type, run in a worker process
+    """
+    key, X_group, metric, chunk_size = task
+    cell_type = key[1]
+    cross_term = _pairwise_mean(X_group, _vehicle_pools[cell_type], metric, chunk_size)
+    self_term = _pairwise_mean(X_group, X_group, metric, chunk_size)
+    return key, 2 * cross_term - self_term - _vehicle_stats[cell_type]["self_term"]
+
+
+def scan_vehicle_distances(adata, metric='sqeuclidean', vehicle='Vehicle', n_workers=None, chunk_size=4096):
+    """
+    E-distance of every compound x cell type x dose group to the vehicle cells of the same cell type.
+
+    Vehicle statistics are computed once per cell type and shared by all groups. With the default
+    squared Euclidean metric the E-distance reduces exactly to 2 * ||mean(group) - mean(vehicle)||²,
+    so all group means come from one streamed pass over X. Any other sklearn metric needs the pairwise
+    terms; the groups are then spread over a process pool of n_workers (default: all cores), with the
+    vehicle pools sent to each worker once. With 'euclidean' the value is the V-statistic (means over the
+    full pairwise matrices) of 2 E||X - Y|| - E||X - X'|| - E||Y - Y'||, i.e. the squared energy
+    distance, without the square root that scipy.stats.energy_distance applies.
+
+    Returns a DataFrame with compound, dose, cell_type, e_dist and sample_size columns.
+    """
+    obs = adata.obs
+    X = adata.X
+    compounds = obs['product_name'].to_numpy()
+    cell_types = obs['cell_type'].to_numpy()
+
+    order, offsets, keys = group_rows(compounds, cell_types, obs['dose'].to_numpy())
+    sizes = np.diff(offsets)
+
+    vehicle_rows = {cell_type: np.flatnonzero((compounds == vehicle) & (cell_types == cell_type))
+                    for cell_type in pd.unique(cell_types)}
+    for cell_type, rows in vehicle_rows.items():
+        if len(rows) == 0:
+            raise ValueError(f"No vehicle controls for cell type: {cell_type}")
+
+    if metric == 'sqeuclidean':
+        # sums of every group and of every vehicle pool through one sparse indicator matrix,
+        # streamed over row chunks of X
+        group_labels = np.repeat(np.arange(len(keys)), sizes)
+        pool_labels = [np.full(len(rows), len(keys) + i) for i, rows in enumerate(vehicle_rows.values())]
+        indicator = sp.csr_matrix((np.ones(len(order) + sum(map(len, pool_labels))),
+                                   (np.concatenate([group_labels] + pool_labels),
+                                    np.concatenate([order] + list(vehicle_rows.values())))),
+                                  shape=(len(keys) + len(vehicle_rows), len(compounds)))
+
+        sums = np.zeros((indicator.shape[0], X.shape[1]))
+        for start in tqdm(range(0, X.shape[0], chunk_size)):
+            stop = min(start + chunk_size, X.shape[0])
+            sums += indicator[:, start:stop] @ _dense(X[start:stop]).astype(np.float64, copy=False)
+
+        means = sums[:len(keys)] / sizes[:, None]
+        vehicle_means = {cell_type: sums[len(keys) + i] / len(rows)
+                         for i, (cell_type, rows) in enumerate(vehicle_rows.items())}
+
+        diff = means - np.stack([vehicle_means[key[1]] for key in keys])
+        e_dists = dict(zip(keys, 2 * (diff ** 2).sum(axis=1)))
+    else:
+        vehicle_pools = {cell_type: read_rows(X, rows) for cell_type, rows in vehicle_rows.items()}
+        vehicle_stats = {cell_type: vehicle_statistics(V, metric, chunk_size) for cell_type, V in vehicle_pools.items()}
+
+        n_workers = n_workers or os.cpu_count()
+        e_dists = dict()
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(vehicle_pools, vehicle_stats)) as executor, \
+                tqdm(total=len(keys)) as progress:
+            # groups are read and submitted in a bounded window, so at most a few groups are held at once
+            pending = set()
+            for i, key in enumerate(keys):
+                if len(pending) >= 2 * n_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    e_dists.update(future.result() for future in done)
+                    progress.update(len(done))
+                task = (key, read_rows(X, order[offsets[i]:offsets[i + 1]]), metric, chunk_size)
+                pending.add(executor.submit(_scan_group, task))
+
+            done, _ = wait(pending)
+            e_dists.update(future.result() for future in done)
+            progress.update(len(done))
+
+    results = [{"compound": compound, "dose": dose, "cell_type": cell_type,
+                "e_dist": e_dists[(compound, cell_type, dose)], "sample_size": size}
+               for (compound, cell_type, dose), size in zip(keys, sizes)]
+    return pd.DataFrame(results)